@@ -24,6 +24,12 @@ class App:
     fmt = None # forsed format of input file
     outdir = None # output directory
     publish = None # publish URL (if publish option is used)
+    stream = False # stream output files
+    nocache = False # don't use cache of parsed documents
+    incremental = False # skip output files with not changed inputs
+    onlychanged = False # don't replace output files with the same content
+    jobs = 1 # number of threads fetching included files
+    offline = False # use cached HTTP files if server is unreachable
 
     def print_usage(self):
         def parser_info(cls):
@@ -50,8 +56,8 @@ class App:
 
         USAGE = '''\
 %s
-Syntax: -i FILE [-f FMT] [-c CFG] [-u URLCFG] [-o DIR] [-x] [-r] [-p URL] [-q]
-[-h]
+Syntax: -i FILE [-f FMT] [-c CFG] [-u URLCFG] [-o DIR] [-x] [-r] [-p URL] [-q] [-j N]
+[--stream] [--no-cache] [--incremental] [--only-changed] [--offline] [-h]
    -i FILE      Input file or URL
    -f FMT       Force format (extension)
    -c CFG       Path to configuration file
@@ -61,6 +67,14 @@ Syntax: -i FILE [-f FMT] [-c CFG] [-u URLCFG] [-o DIR] [-x] [-r] [-p URL] [-q]
    -r           Flush references file
    -p URL       Prepare HTML for WEB publishing (with base URL or '.' to skip)
    -q           Quiet
+   -j N         Fetch included files by N threads
+   --stream     Stream output files while expanding (less memory)
+   --no-cache   Don't use caches of parsed documents and HTTP files
+   --incremental
+                Don't rewrite output files which inputs are not changed
+   --only-changed
+                Don't replace output files with the same content
+   --offline    Use cached HTTP files if server is unreachable
    -h           This help
 Supported formats:
 %s
@@ -76,7 +90,8 @@ Supported schemes:
         (help printing is only need)
         """
         try:
-            opts, args = getopt.getopt(sys.argv[1:], 'rxqhi:f:c:u:o:p:', [])
+            opts, args = getopt.getopt(sys.argv[1:], 'rxqhi:f:c:u:o:p:j:', ['stream', 'no-cache', 'incremental',
+                'only-changed', 'offline'])
         except getopt.GetoptError as x:
             sys.stderr.write('Syntax error! See help (-h)\n')
             sys.exit(1)
@@ -104,6 +119,22 @@ Supported schemes:
                 self.publish = '' if v == '.' else v
             elif o == '-q':
                 self.quiet = True
+            elif o == '-j':
+                try:
+                    self.jobs = int(v)
+                except ValueError:
+                    sys.stderr.write('Syntax error! See help (-h)\n')
+                    sys.exit(1)
+            elif o == '--stream':
+                self.stream = True
+            elif o == '--no-cache':
+                self.nocache = True
+            elif o == '--incremental':
+                self.incremental = True
+            elif o == '--only-changed':
+                self.onlychanged = True
+            elif o == '--offline':
+                self.offline = True
 
         if _UsageAndExit:
             return False
@@ -147,24 +178,36 @@ Supported schemes:
                 self.print_usage()
                 sys.exit(0)
 
+            parsecache = None if self.nocache else lp.ParseCache()
+            httpcache = None if self.nocache else lp.HTTPCache()
             if self.publish is not None:
                 # if need to publish...
-                engine = lp.Lp(cfgfile=self.cfgfile, urlcfgfile=self.urlcfgfile, quiet=self.quiet, outdir=self.outdir)
-                parser = lp.Parser.create_parser(engine, self.input_file, fmt=self.fmt)
-                parser.parsefile(self.input_file, flush=False)
-                pub = lp.Publisher(parser, baseurl=self.publish)
-                pub.publish(self.input_file)
+                engine = lp.Lp(cfgfile=self.cfgfile, urlcfgfile=self.urlcfgfile, quiet=self.quiet, outdir=self.outdir,
+                        parsecache=parsecache, jobs=self.jobs, httpcache=httpcache,
+                        offline=self.offline)
             else:
-                engine = lp.Lp(cfgfile=self.cfgfile, urlcfgfile=self.urlcfgfile, quiet=self.quiet, outdir=self.outdir)
+                engine = lp.Lp(cfgfile=self.cfgfile, urlcfgfile=self.urlcfgfile, quiet=self.quiet, outdir=self.outdir,
+                        stream=self.stream, parsecache=parsecache, incremental=self.incremental,
+                        onlychanged=self.onlychanged, jobs=self.jobs, httpcache=httpcache,
+                        offline=self.offline)
+            try:
                 parser = lp.Parser.create_parser(engine, self.input_file, fmt=self.fmt)
-                parser.parsefile(self.input_file)
-
-            if self.refs:
-                # if need to flush references...
-                fn = os.path.split(self.input_file)[1]
-                fn = fn.upper()
-                refsfile = lp.RefsFile(parser, "%s: references"%fn)
-                refsfile.save()
+                if self.publish is not None:
+                    parser.parsefile(self.input_file, flush=False)
+                    pub = lp.Publisher(parser, baseurl=self.publish)
+                    pub.publish(self.input_file)
+                else:
+                    parser.parsefile(self.input_file)
+
+                if self.refs:
+                    # if need to flush references...
+                    fn = os.path.split(self.input_file)[1]
+                    fn = fn.upper()
+                    refsfile = lp.RefsFile(parser, "%s: references"%fn)
+                    refsfile.save()
+            finally:
+                # fetchers connections are closed (with summary) even on errors
+                engine.close()
 
         if self.tb:
             _do()
@@ -5,6 +5,7 @@
 
 import os
 import re
+import shutil
 import nanolp.core as core
 
 class UseCmd(core.Cmd):
@@ -23,8 +24,14 @@ class UseCmd(core.Cmd):
         if not self.infile:
             raise core.ParserError("'use' can not ensure '%s' input file"%infile)
         core.prn("using '%s' mounted to '%s'..."%(self.infile, mnt), engine=parser.engine, file='stdout')
-        inclparser = core.Parser.create_parser(parser.engine, self.infile, fmt=fmt, parent=parser)
-        inclparser.parsefile(self.infile, flush=False)
+        includes = parser.getrootparser().includes
+        inclparser = includes.pop(self) if includes else None
+        if inclparser:
+            # already fetched and loaded by IncludeResolver
+            inclparser.postprocess(flush=False)
+        else:
+            inclparser = core.Parser.create_parser(parser.engine, self.infile, fmt=fmt, parent=parser)
+            inclparser.parsefile(self.infile, flush=False)
         parser.importparser(inclparser, mnt)
         return core.Cmd.onpost(self, parser=parser, flush=flush)
 core.Cmd.register(UseCmd)
@@ -40,22 +47,66 @@ class FileCmd(core.Cmd):
 
     def onpost(self, parser=None, flush=None):
         if flush:
-            jpath = self.jpath()
-            chunk = parser.chunkdict.getbykey(self)
-            if not parser.expand(jpath):
-                raise core.ParserError("'%s' can not be expanded"%jpath)
-            # body of out is output file name
+            # body of out is output file name. File will be written by
+            # parser.tangle_all() after post-processing of all commands
             self.outfile = ''.join(self.body)
             self.outfile = os.path.join(parser.outdir, self.outfile)
             self.outfile = os.path.abspath(self.outfile)
-            # if self.outfile has relative path, real outdir can be different then
-            # in parser. If not exists, create it
-            outdir = os.path.dirname(self.outfile)
-            if not os.path.exists(outdir):
-                os.makedirs(outdir)
-            core.prn("writing to '%s'..."%self.outfile, engine=parser.engine, file='stdout')
-            core.fwrite23(self.outfile, chunk.tangle)
         return core.Cmd.onpost(self, parser=parser, flush=flush)
+
+    def write(self, parser, text):
+        """Write expanded text to self.outfile. Text is written to temporary
+        file in the same dir., which replaces outfile at the end (atomically).
+        Text can be iterable of fragments (see ChunkDict.iterexpand()); if
+        fragments can not be streamed, text is expanded usually. In onlychanged
+        mode of engine outfile with the same content is not replaced (and it's
+        mtime is kept). Mode of existing outfile is kept. Returns True if
+        outfile was written, False if it's not changed
+
+        >>> outdir = tempfile.mkdtemp()
+        >>> cmd = Cmd.create_cmd('<<file.x, run.sh>>')
+        >>> cmd.outfile = os.path.join(outdir, 'run.sh')
+        >>> fwrite23(cmd.outfile, 'echo old')
+        >>> os.chmod(cmd.outfile, 0o755)
+        >>> cmd.write(Parser(), 'echo new') # doctest: +ELLIPSIS
+        writing to '...run.sh'...
+        True
+        >>> fread23(cmd.outfile) == 'echo new', stat.S_IMODE(os.stat(cmd.outfile).st_mode) == 0o755
+        (True, True)
+        >>> os.remove(cmd.outfile); os.rmdir(outdir)
+        """
+        # if self.outfile has relative path, real outdir can be different then
+        # in parser. If not exists, create it
+        outdir = os.path.dirname(self.outfile)
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+        # in the same dir, so replacing is rename
+        tmpfile = '%s.%d.tmp'%(self.outfile, os.getpid())
+        try:
+            if isinstance(text, core.StringTypes23):
+                core.fwrite23(tmpfile, text)
+            else:
+                try:
+                    core.fwritelines23(tmpfile, text)
+                except core.ChunkDictStreamError:
+                    # fragments can not be streamed, so text is expanded usually
+                    jpath = self.jpath()
+                    if not parser.expand(jpath):
+                        raise core.ParserError("'%s' can not be expanded"%jpath)
+                    core.fwrite23(tmpfile, parser.chunkdict.getbykey(self).tangle)
+            if parser.engine and parser.engine.onlychanged and \
+                    os.path.exists(self.outfile) and core.samecontent(tmpfile, self.outfile):
+                core.prn("'%s' is not changed"%self.outfile, engine=parser.engine, file='stdout')
+                return False
+            core.prn("writing to '%s'..."%self.outfile, engine=parser.engine, file='stdout')
+            if os.path.exists(self.outfile):
+                # replacing file should not change mode (exec. bit, etc)
+                shutil.copymode(self.outfile, tmpfile)
+            core.freplace23(tmpfile, self.outfile)
+            return True
+        finally:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
 core.Cmd.register(FileCmd)
 
 ################################################################################
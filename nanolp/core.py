@@ -8,19 +8,30 @@ __ABOUT__ = 'Nano LP, v. %s'%__VERSION__
 
 import re
 import os
+import io
 import sys
+import time
 import copy
+import mmap
+import codecs
 import stat
 import pprint
+import bisect
+import hashlib
 #import atexit
 import string
 import random
+import base64
 import inspect
 import fnmatch
+import json
 import datetime
 import warnings
 import calendar
 import tempfile
+import weakref
+import threading
+import array
 import itertools
 import functools
 import xml.sax as sax
@@ -414,6 +425,47 @@ def fix_crlf(buf):
     """
     return buf.replace('\r\n', '\n')
 
+def filedigest(path, algorithm='sha1', blocksize=1<<16):
+    """Returns hex digest of file content, file is read by blocks
+
+    >>> fdtmp,ntmp = tempfile.mkstemp()
+    >>> os.write(fdtmp, b'abc') == 3
+    True
+    >>> os.close(fdtmp)
+    >>> filedigest(ntmp) == hashlib.sha1(b'abc').hexdigest()
+    True
+    >>> os.remove(ntmp)
+    """
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def samecontent(path1, path2):
+    """Files path1, path2 have the same content: sizes are compared first,
+    then digests
+
+    >>> fd1,n1 = tempfile.mkstemp()
+    >>> fd2,n2 = tempfile.mkstemp()
+    >>> os.write(fd1, b'abc') == os.write(fd2, b'abc') == 3
+    True
+    >>> samecontent(n1, n2)
+    True
+    >>> os.write(fd2, b'd') == 1
+    True
+    >>> samecontent(n1, n2)
+    False
+    >>> os.write(fd1, b'e') == 1
+    True
+    >>> samecontent(n1, n2)
+    False
+    >>> for fd,n in ((fd1,n1), (fd2,n2)): os.close(fd); os.remove(n)
+    """
+    if os.path.getsize(path1) != os.path.getsize(path2):
+        return False
+    return filedigest(path1) == filedigest(path2)
+
 def normnegindex(i, count):
     """Normalize negative index i of count items
 
@@ -563,6 +615,59 @@ def indenttext(text, indent, first=False, cr='\n'):
         lines[i] = indent + lines[i]
     return cr.join(lines)
 
+class TextIndenter:
+    """Streaming version of indenttext(): feed() gets text fragments and
+    returns indented fragments (line break is delayed until next line, last
+    one is dropped), so joined result is the same as indenttext() of joined
+    fragments
+
+    >>> ti = TextIndenter('  ')
+    >>> text = ''.join(ti.feed(s) for s in ('a\\r', '\\nb', '', 'b\\n\\n', 'c\\n'))
+    >>> text
+    'a\\n  bb\\n  \\n  c'
+    >>> text == indenttext('a\\r\\nbb\\n\\nc\\n', '  ')
+    True
+    >>> ti = TextIndenter('  ', first=True)
+    >>> ti.feed('\\n'), ti.feed('x')
+    ('  ', '\\n  x')
+    """
+    ## indent string
+    indent = ''
+    ## indent first line too
+    first = False
+    ## line break of result
+    cr = '\n'
+
+    def __init__(self, indent, first=False, cr='\n'):
+        self.indent = indent
+        self.first = first
+        self.cr = cr
+        # was any line, is line break pending, is it '\r' (may be '\r\n')
+        self._started = False
+        self._pending = False
+        self._afterr = False
+
+    def feed(self, text):
+        """Returns indented text fragment"""
+        out = []
+        for piece in text.splitlines(True):
+            if self._afterr and piece == '\n':
+                # rest of '\r\n', splitted between fragments
+                self._afterr = False
+                continue
+            self._afterr = False
+            line = piece.splitlines()[0]
+            if not self._started:
+                self._started = True
+                if self.first:
+                    out.append(self.indent)
+            elif self._pending:
+                out.append(self.cr + self.indent)
+            out.append(line)
+            self._pending = len(line) < len(piece)
+            self._afterr = piece.endswith('\r')
+        return ''.join(out)
+
 def deltextindent(text, cr='\n'):
     """Remove indentation of text
 
@@ -579,7 +684,7 @@ def deltextindent(text, cr='\n'):
     '\\naaa\\n  bbb\\n\\n\\ncc'
     """
     lines = text.splitlines()
-    minindent = min(len(indentstr(s, 0)) for s in lines if s)
+    minindent = min(len(s) - len(s.lstrip(' \t')) for s in lines if s)
     return cr.join(s[minindent:] for s in lines)
 
 def user_input(msg, chkfunc=None, prompt='\n> ', quiet=False):
@@ -628,6 +733,89 @@ def prn(*args, **opts):
     else:
         fwrite23(out, s, mode='a+t')
 
+class CacheInfo(namedtuple('CacheInfo', ['hits', 'misses', 'size', 'maxsize'])):
+    """Statistics of LRUCache"""
+    __slots__ = ()
+
+    @property
+    def hitrate(self):
+        """Part of hits in all get() calls"""
+        total = self.hits + self.misses
+        return float(self.hits)/total if total else 0.0
+
+class LRUCache:
+    """Dictionary with limited size: least recently used items are removed
+    when size exceeds maxsize (onevict(key, value) is called for them)
+
+    >>> c = LRUCache(2)
+    >>> c['a'] = 1; c['b'] = 2
+    >>> c.get('a')
+    1
+    >>> c['c'] = 3
+    >>> 'b' in c, 'a' in c, len(c)
+    (False, True, 2)
+    >>> c.get('b', 0)
+    0
+    >>> c.hits, c.misses
+    (1, 1)
+    >>> c.info(), c.info().hitrate
+    (CacheInfo(hits=1, misses=1, size=2, maxsize=2), 0.5)
+    >>> evicted = []
+    >>> c = LRUCache(1, onevict=lambda k, v: evicted.append((k, v)))
+    >>> c['a'] = 1; c['b'] = 2
+    >>> evicted, c.values()
+    ([('a', 1)], [2])
+    """
+    ## max. number of items
+    maxsize = 0
+    ## counters of get() results
+    hits = 0
+    misses = 0
+
+    ## called with key, value of removed item (or None)
+    onevict = None
+
+    def __init__(self, maxsize=128, onevict=None):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.onevict = onevict
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._items[key] = value # now is most recently used
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        while len(self._items) > self.maxsize:
+            key, value = self._items.popitem(last=False)
+            if self.onevict:
+                self.onevict(key, value)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def values(self):
+        return list(self._items.values())
+
+    def clear(self):
+        self._items.clear()
+
+    def info(self):
+        """Returns CacheInfo"""
+        return CacheInfo(self.hits, self.misses, len(self._items), self.maxsize)
+
 ################################################################################
 # }}}
 
@@ -859,15 +1047,21 @@ class CmdSyntax:
     _surrstack = None
     ## regexps templates (as dict.)
     _re = None
+    ## compiled regexps of not parameterized tokens {(token, flags): regexp}
+    ## for current surr. symbols
+    _cre = None
+    ## compiled parameterized regexps {(token, surr, flags, kw): regexp}
+    _kwcre = None
 
     def _reset(self):
         self._surr = {}
         self._surrstack = []
         self._re = {}
+        self._cre = {}
+        self._kwcre = LRUCache(256)
 
     def __init__(self, surr=None):
         self._reset()
-        self.setsurr(surr)
         self._re = {
             # token: regexp ({0} - left surr, {1} - right surr)
             'cmddef': '{0}(?!=)(.+?){1}',
@@ -875,6 +1069,7 @@ class CmdSyntax:
             'argsubst': '\$[^ $]+',
             'concrcmdsubst': '{0}={path}(,.+?)?{1}'
         }
+        self.setsurr(surr)
 
     def getsurr(self):
         return self._surr['def'] + self._surr['subst']
@@ -908,6 +1103,7 @@ class CmdSyntax:
         last 2 - for pasting
         """
         if not surr: surr = ('<<', '>>')
+        cursurr = self.getsurr() if self._surr else None
         # set surr. symbols for cmd. definition and cmd. substitution (pasting)
         if len(surr) == 2:
             self._surr['def'] = tuple(surr)
@@ -915,6 +1111,12 @@ class CmdSyntax:
         elif len(surr) > 2:
             self._surr['def'] = tuple(surr[0:2])
             self._surr['subst'] = tuple(surr[2:4])
+        if self.getsurr() != cursurr:
+            # compile not parameterized tokens regexps for new surr. symbols
+            self._cre = {}
+            for token in self._re:
+                if token != 'concrcmdsubst':
+                    self._cre[(token, 0)] = re.compile(self._getre(token))
 
     def surround(self, context, text):
         """Surround some text with surr. symbols actual for context ('def'|'subst')
@@ -942,14 +1144,36 @@ class CmdSyntax:
         else: surr = []
         return e.format(*(re.escape(s) for s in surr), **kw)
 
+    def getcre(self, token, flags=None, **kw):
+        """Returns compiled regexp. Not parameterized are compiled when surr.
+        symbols are changed, parameterized (with kw) are cached
+
+        >>> cs = CmdSyntax(['(', ')', '[[', ']]'])
+        >>> cs.getcre('cmddef').pattern == cs._getre('cmddef')
+        True
+        >>> cs.getcre('concrcmdsubst', path='x') is cs.getcre('concrcmdsubst', path='x')
+        True
+        >>> cs.pushsurr(('<<', '>>'))
+        >>> cs.getcre('cmddef').pattern == cs._getre('cmddef')
+        True
+        """
+        flags = flags or 0
+        if not kw:
+            cre = self._cre.get((token, flags))
+            if cre is None:
+                cre = self._cre[(token, flags)] = re.compile(self._getre(token), flags)
+            return cre
+        key = (token, self.getsurr(), flags, tuple(sorted(kw.items())))
+        cre = self._kwcre.get(key)
+        if cre is None:
+            cre = re.compile(self._getre(token, **kw), flags)
+            self._kwcre[key] = cre
+        return cre
+
     def findtokens(self, token, text, flags=None, **kw):
         """Find (iterator) of all parameterized by kw tokens in text with re flags
         """
-        e = self._getre(token, **kw)
-        reargs = [e, text]
-        if flags: reargs.append(flags)
-        it = re.finditer(*reargs)
-        for m in it: yield m
+        return self.getcre(token, flags, **kw).finditer(text)
 
     def subtokens(self, token, repl, text, count=0, flags=None, **kw):
         """Substitute token, parameterized by kw with repl (may be func) count times
@@ -961,10 +1185,7 @@ class CmdSyntax:
         >>> cs.subtokens('cmdsubst', 'xxx', 'Aaa [[=one]] and [[=two]] bbb')
         'Aaa xxx and xxx bbb'
         """
-        e = self._getre(token, **kw)
-        reargs = [e, repl, text, count]
-        if flags: reargs.append(flags)
-        return re.sub(*reargs)
+        return self.getcre(token, flags, **kw).sub(repl, text, count)
 
     def istoken(self, token, text, flags=None, **kw):
         """Test if text is matched by parameterized with kw token with re flags
@@ -983,10 +1204,7 @@ class CmdSyntax:
         >>> cs.istoken('concrcmdsubst', '<<=x.y>>', path='x')
         False
         """
-        e = self._getre(token, **kw)
-        reargs = [e, text]
-        if flags: reargs.append(flags)
-        return bool(re.match(*reargs))
+        return bool(self.getcre(token, flags, **kw).match(text))
 
     def strip(self, text):
         """Try to treats text ad cmd. definition or cmd. substitution and to remove
@@ -1016,6 +1234,9 @@ class CmdSyntax:
 
 class CmdError(Exception): pass
 
+## parsed text of command (see Cmd.parseheader())
+CmdHeader = namedtuple('CmdHeader', ['text', 'ispaste', 'isset', 'path', 'args', 'body'])
+
 class Cmd:
     """Parse text into internal fields
 
@@ -1071,9 +1292,12 @@ class Cmd:
     srcinfo = None; SrcInfo = default_attributes(infile='')
     ## additional info related to multiple parts
     setinfo = None; SetInfo = default_attributes(size=1)
+    ## ChunkKey of path, args, body (see key())
+    _key = None
 
     def _reset(self):
         """Reset internal fields"""
+        self._key = None
         self.text = ""
         self.ispaste = False
         self.isset = False
@@ -1084,8 +1308,8 @@ class Cmd:
         self.srcinfo = self.SrcInfo()
         self.setinfo = self.SetInfo()
 
-    def __init__(self, text=None, indent='', cmd=None, setinfo=None):
-        """Init from another cmd, or from text
+    def __init__(self, text=None, indent='', cmd=None, setinfo=None, header=None):
+        """Init from another cmd, or from text, or from parsed text (CmdHeader)
         """
         if cmd:
             self._reset()
@@ -1093,21 +1317,95 @@ class Cmd:
             self.__dict__.update((k,v) for k,v in cmd.__dict__.items() if k not in SKIP)
         else:
             self._reset()
-            if text is not None:
-                if not Cmd.syntax.istoken('cmddef', text) \
-                        and not Cmd.syntax.istoken('cmdsubst', text):
-                    # seems path, not cmd. definition
-                    text = Cmd.syntax.surround('def', text)
-                self.parse(text)
+            if header is None and text is not None:
+                header = Cmd.getheader(text)
+            if header is not None:
+                self._setheader(header)
             self.indent = indent
             if setinfo:
                 self.setinfo = setinfo
 
+    ## {(surr. symbols, text): CmdHeader} - parsed texts of getheader(), it's
+    ## maxsize can be changed (see headercache.info() for hit rate)
+    headercache = LRUCache(4096)
+
+    @staticmethod
+    def getheader(text):
+        """Returns CmdHeader of text (cmd. definition or path), memoized by
+        surr. symbols and text. Header is immutable, so per-occurrence state
+        (indent, setinfo, srcinfo) is kept in Cmd only
+
+        >>> h = Cmd.getheader('<<c.f, x:1>>')
+        >>> Cmd.getheader('<<c.f, x:1>>') is h, h.path, h.args
+        (True, ('c', 'f'), (('x', '1'),))
+        >>> Cmd.syntax.pushsurr(['(', ')', '((', '))'])
+        >>> Cmd.getheader('<<c.f, x:1>>') is h, Cmd.getheader('<<c.f, x:1>>').path
+        (False, ('<<c', 'f'))
+        >>> Cmd.syntax.popsurr()
+        """
+        key = (Cmd.syntax.getsurr(), text)
+        header = Cmd.headercache.get(key)
+        if header is None:
+            header = Cmd.parseheader(Cmd.cmdtext(text))
+            Cmd.headercache[key] = header
+        return header
+
+    @staticmethod
+    def cmdtext(text):
+        """Returns text of cmd. definition: text or path surrounded with
+        surr. symbols
+        """
+        if not Cmd.syntax.istoken('cmddef', text) \
+                and not Cmd.syntax.istoken('cmdsubst', text):
+            # seems path, not cmd. definition
+            text = Cmd.syntax.surround('def', text)
+        return text
+
+    ## {first path component: [(order, class, compiled gpath)]} - dispatch
+    ## table of registered commands, compiled by register()
+    _dispatch = {}
+    ## the same list for gpaths with glob first component or with index
+    _dispatchglob = []
+
     @staticmethod
     def register(cmd):
         """Register new special command"""
         cmd._isregistered = True
         Cmd.commands.append(cmd)
+        gpath = cmd.gpath
+        first = gpath.split('.')[0]
+        if Cmd.pathindex(gpath) is not None:
+            # depends on setinfo size, see dispatch()
+            entry = (len(Cmd.commands), cmd, None)
+        else:
+            entry = (len(Cmd.commands), cmd, Cmd.globre(gpath))
+        if entry[2] is None or any(ch in first for ch in ChunkDict.GLOBCHARS):
+            Cmd._dispatchglob.append(entry)
+        else:
+            Cmd._dispatch.setdefault(first, []).append(entry)
+
+    @staticmethod
+    def dispatch(path, setinfo=None):
+        """Returns class of registered command for path (list of components),
+        or Cmd if there is no such
+
+        >>> Cmd.dispatch(['use']) is UseCmd
+        True
+        >>> Cmd.dispatch(['c', 'use']) is Cmd
+        True
+        """
+        candidates = Cmd._dispatch.get(path[0], ()) if path else ()
+        if Cmd._dispatchglob:
+            candidates = sorted(list(candidates) + Cmd._dispatchglob, key=lambda e: e[0])
+        jpath = '.'.join(path)
+        for _, cls, cre in candidates:
+            if cre is None:
+                size = setinfo.size if setinfo else Cmd.SetInfo().size
+                gpath = Cmd._normpathindex(cls.gpath, size) or cls.gpath
+                cre = Cmd.globre(gpath)
+            if cre.match(jpath):
+                return cls
+        return Cmd
 
     @staticmethod
     def get_uniform_commands(name):
@@ -1136,12 +1434,9 @@ class Cmd:
         >>> isinstance(c, UseCmd)
         False
         """
-        cmd = Cmd(text=text, indent=indent, setinfo=setinfo)
-        for cls in Cmd.commands:
-            if cmd.matchpath(cls.gpath):
-                return cls(cmd=cmd)
-        else:
-            return cmd
+        header = None if text is None else Cmd.getheader(text)
+        cls = Cmd.dispatch(header.path if header else (), setinfo)
+        return cls(indent=indent, setinfo=setinfo, header=header)
 
     @staticmethod
     def isregistered(c):
@@ -1149,7 +1444,7 @@ class Cmd:
         returns False then c is user command (definition!)
         """
         if isinstance(c, StringTypes23):
-            c = Cmd.create_cmd(c)
+            return Cmd.dispatch(Cmd.getheader(c).path)._isregistered
         return c._isregistered
 
     @staticmethod
@@ -1201,14 +1496,19 @@ class Cmd:
         Returns normalized path or original if no index or index is positive.
         If index is out-of-set-size, returns None!
         """
+        return Cmd._normpathindex(path, self.setinfo.size)
+
+    @staticmethod
+    def _normpathindex(path, size):
+        """normpathindex() for set of size parts"""
         index = Cmd.pathindex(path)
         if index is None:
             return path
         elif index >= 0:
-            if index >= self.setinfo.size: return None
+            if index >= size: return None
             else: return path
         else:
-            index = normnegindex(index, self.setinfo.size)
+            index = normnegindex(index, size)
             if index is None: return None
             return Cmd.changepathindex(path, index)
 
@@ -1225,9 +1525,19 @@ class Cmd:
         """
         normgpath = self.normpathindex(gpath)
         if normgpath: gpath = normgpath
-        re_ = fnmatch.translate(gpath)
-        cre = re.compile(re_)
-        return bool(cre.match(self.jpath()))
+        return bool(Cmd.globre(gpath).match(self.jpath()))
+
+    ## compiled glob patterns of matchpath()
+    _globres = LRUCache(512)
+
+    @staticmethod
+    def globre(gpath):
+        """Returns compiled regexp for glob-style path pattern"""
+        cre = Cmd._globres.get(gpath)
+        if cre is None:
+            cre = re.compile(fnmatch.translate(gpath))
+            Cmd._globres[gpath] = cre
+        return cre
 
     def setpath(self, path=None, prefix=None, suffix=None):
         """Change path with optional prefix (str|list|tuple),
@@ -1256,8 +1566,25 @@ class Cmd:
         if isinstance(prefix, StringTypes23):
             prefix = prefix.split('.')
         self.path = list(prefix) + list(path) + list(suffix)
+        self._key = None
         return self.path
 
+    def key(self):
+        """Returns ChunkKey of cmd (path, args and body), it's cached until
+        path is changed
+
+        >>> c = Cmd.create_cmd('<<c.f, x:1>>')
+        >>> c.key() is Cmd.create_cmd('<<c.f,  x: 1>>').key()
+        True
+        >>> c.setpath(prefix='a')
+        ['a', 'c', 'f']
+        >>> c.key()
+        ChunkKey('a.c.f')
+        """
+        if self._key is None:
+            self._key = ChunkKey.create(self.path, self.args, self.body)
+        return self._key
+
     def __hash__(self):
         """Generate key when object is used as key
 
@@ -1273,8 +1600,7 @@ class Cmd:
         >>> Cmd.create_cmd('<<c.f1>>') in d
         False
         """
-        factors = (tuple(self.path), tuple(self.args), tuple(self.body))
-        return hash(factors)
+        return hash(self.key())
 
     def __eq__(self, oth):
         if isinstance(oth, Cmd):
@@ -1419,62 +1745,104 @@ class Cmd:
         True
         >>> Cmd.syntax.popsurr()
         """
-        # denied in kw arg name
-        _ArgNameDeniedSymbols = string.punctuation.replace('.', '')
+        self._reset()
+        self._setheader(Cmd.parseheader(text))
+        return True
 
-        def _quote_text(txt):
-            for i,q in enumerate(CMDQUOTE):
-                txt = txt.replace(r'\%s'%q, '@Q%d@'%i)
-            return txt
-        def _unquote_text(txt):
-            for i,q in enumerate(CMDQUOTE):
-                txt = txt.replace('@Q%d@'%i, q)
-            return txt
+    def _setheader(self, header):
+        """Set fields from parsed text (CmdHeader)"""
+        self.text = header.text
+        self.ispaste = header.ispaste
+        self.isset = header.isset
+        self.path = list(header.path)
+        self.args = list(header.args)
+        self.body = list(header.body)
+        self._key = None
+
+    ## lexemes of cmd. text: escaped punctuation symbol, separator, other text
+    _lexre = re.compile(r'\\([%s])|([,:])|[^\\,:]+|\\'%re.escape(CMDQUOTE))
+    ## lexemes of path: escaped symbol, separator, other text
+    _pathlexre = re.compile(r'\\[%s]|\.|[^\\.]+|\\'%re.escape(CMDQUOTE))
+    ## symbols denied in kw arg name
+    _argnamedenied = frozenset(CMDQUOTE.replace('.', ''))
 
-        self._reset()
+    @staticmethod
+    def parseheader(text):
+        """Parse text of command, returns CmdHeader. Text is scanned once:
+        ',' separates path, args and body items, first ':' separates arg
+        name and value, '\\' escapes punctuation symbol (escaped symbols are
+        kept with '\\' in path and in '*' args)
+
+        >>> h = Cmd.parseheader('<<=c.sum, a:1\\:2, x\\,y, *:*>>')
+        >>> h.ispaste, h.isset, h.path, h.args, h.body
+        (True, False, ('c', 'sum'), (('a', '1:2'), ('novars', True)), ('x,y',))
+        >>> Cmd.parseheader('<<c\\.d.*, *:$v\\,>>').path == ('c\\.d', '*')
+        True
+        """
         if not Cmd.syntax.istoken('cmddef', text) \
                 and not Cmd.syntax.istoken('cmdsubst', text):
             raise CmdError('mismatch form')
 
-        self.text = text
-        text = Cmd.syntax.strip(text)
+        # items are (raw name, name, raw text, text), name is None if no ':',
+        # raw is with escapes
+        items = []
+        rawname = name = None
+        raw = []; cooked = []
+        for m in Cmd._lexre.finditer(Cmd.syntax.strip(text)):
+            esc, sep = m.group(1), m.group(2)
+            if esc is not None:
+                raw.append(m.group(0))
+                cooked.append(esc)
+            elif sep is None or (sep == ':' and (rawname is not None or not items)):
+                # text, ':' in path or in arg value
+                raw.append(m.group(0))
+                cooked.append(m.group(0))
+            elif sep == ',':
+                items.append((rawname, name, ''.join(raw), ''.join(cooked)))
+                rawname = name = None
+                raw = []; cooked = []
+            else:
+                # first ':' in arg
+                rawname, name = ''.join(raw), ''.join(cooked)
+                raw = []; cooked = []
+        items.append((rawname, name, ''.join(raw), ''.join(cooked)))
 
-        text = _quote_text(text)
-        tmp = [t.strip() for t in text.split(',')]
-        pathpart, args = tmp[0], tmp[1:]
+        pathpart = items[0][2].strip()
         if not pathpart:
             raise CmdError('empty path')
-
-        if pathpart[0] == '=':
-            self.path = pathpart[1:].split('.')
-            self.ispaste = True
+        ispaste = pathpart[0] == '='
+        if ispaste:
+            pathpart = pathpart[1:]
+        if '\\' in pathpart:
+            path = ['']
+            for m in Cmd._pathlexre.finditer(pathpart):
+                if m.group(0) == '.': path.append('')
+                else: path[-1] += m.group(0)
         else:
-            self.path = pathpart.split('.')
-            self.ispaste = False
-        self.isset = '*' in self.path
-
-        for arg in args:
-            if not arg:
-                raise CmdError('missed arg')
-            tmp = [t.strip() for t in arg.split(':', 1)]
-            tmplen = len(tmp)
-            if tmplen == 1:
-                tmp[0] = _unquote_text(tmp[0])
-                self.body.append(tmp[0])
-            elif tmplen == 2:
-                # process argument
-                if tmp[0] == '*':
-                    if tmp[1] == '*':
-                        self.args.append(('novars', True))
-                    elif tmp[1].startswith('$'):
-                        self.args.append(('varsdict', tmp[1][1:]))
-                else:
-                    if any(tmp0ch in _ArgNameDeniedSymbols for tmp0ch in tmp[0]):
-                        raise CmdError("arg '%s' contains unallowed symbols"%tmp[0])
-                    tmp[0] = _unquote_text(tmp[0])
-                    tmp[1] = _unquote_text(tmp[1])
-                    self.args.append((tmp[0], tmp[1]))
-        return True
+            path = pathpart.split('.')
+
+        args = []
+        body = []
+        for rawname, name, raw, value in items[1:]:
+            if rawname is None:
+                if not raw.strip():
+                    raise CmdError('missed arg')
+                body.append(value.strip())
+                continue
+            # process argument
+            rawname = rawname.strip()
+            if rawname == '*':
+                raw = raw.strip()
+                if raw == '*':
+                    args.append(('novars', True))
+                elif raw.startswith('$'):
+                    args.append(('varsdict', raw[1:]))
+            else:
+                if any(ch in Cmd._argnamedenied for ch in rawname):
+                    raise CmdError("arg '%s' contains unallowed symbols"%rawname)
+                args.append((name.strip(), value.strip()))
+        return CmdHeader(text=text, ispaste=ispaste, isset='*' in path,
+                path=tuple(path), args=tuple(args), body=tuple(body))
 
     def onsubargs(self, parser=None, name=None, value=None):
         return ((), dict(parser=parser, name=name, value=value))
@@ -1502,21 +1870,27 @@ class Cmd:
 
 ################################################################################
 
-class Chunk:
+ChunkTemplate = namedtuple('ChunkTemplate', ['surr', 'deps', 'isdone',
+    'segments', 'textvars', 'unsafevars', 'simple'])
+
+class Chunk(object):
     """Base class for all chunk handlers, like 'c'
     """
-    ## original text
-    orig = None
-    ## code text
-    tangle = None
-    ## all expanded
-    isdone = None
-    ## dependencies for this chunk (list of Cmd)
-    deps = None
-    ## ID of traversing session (for cycle detection)
-    _walkid = None
-    ## count of visiting (for cycle detection)
-    _nvisits = None
+    __slots__ = (
+        ## original text
+        'orig',
+        ## code text
+        'tangle',
+        ## all expanded
+        'isdone',
+        ## dependencies for this chunk (list of Cmd)
+        'deps',
+        ## compiled orig (ChunkTemplate), see compile()
+        '_template',
+    )
+
+    ## kinds of template segments
+    LITERAL, VAR, PASTE = range(3)
 
     ## regexp for var. placeholders: '$...\b' or '${...}' or '$N' or '$-N' or '$*'
     _varplaceholders_re_ = r'\$({.+?}|\*|-?.+?\b)'
@@ -1545,21 +1919,205 @@ class Chunk:
         False
         """
         self.orig = text
+        self._template = None
         self._reset()
 
     def _reset(self):
         self.tangle = ''
         self.isdone = False
         self.deps = []
-        self._walkid = 0
-        self._nvisits = 0
         # update deps, isdone, tangle (if no deps, tangle is text) from self.orig
         if self.orig is not None:
-            self.deps = self._finddeps(self.orig)
-            if Chunk._isdone(self.orig):
+            template = self.compile()
+            self.deps = template.deps
+            if template.isdone:
                 self.tangle = self.orig # i.e. = text
                 self.isdone = True
 
+    def compile(self):
+        """Compile orig into ChunkTemplate: list of segments (LITERAL, text),
+        (VAR, textvar), (PASTE, index-of-dep), so render() can do substitutions
+        in one join. Template is not 'simple' if one-pass rendering may differ
+        from usual subcmd()/subargs() (then render() uses them). It depends on
+        current surr. symbols (like deps)
+
+        >>> t = Chunk('a $x <<=c.b, y:1>> ${z}').compile()
+        >>> t.segments
+        [(0, 'a '), (1, 'x'), (0, ' '), (2, 0), (0, ' '), (1, '{z}')]
+        >>> t.simple, t.textvars
+        (True, ['x', '{z}'])
+        >>> Chunk('a $x<<=c.b>>').compile().simple
+        False
+        """
+        surr = Cmd.syntax.getsurr()
+        if self._template is not None and self._template.surr == surr:
+            return self._template
+        text = self.orig
+        # start of cmd. substitution ('<<=')
+        lead = surr[2] + '='
+        segments = []
+        textvars = []
+        literals = []
+        deps = []
+        ok = [True] # is simple
+
+        def _addliteral(lit, beforepaste):
+            if not lit: return
+            literals.append(lit)
+            if lead in lit:
+                ok[0] = False
+            pos = 0
+            for m in Chunk._varplaceholders_re.finditer(lit):
+                if beforepaste and (m.end() == len(lit) or
+                        (lit[m.start()+1] == '{' and not m.group(1).endswith('}'))):
+                    # placeholder may continue in pasted text
+                    ok[0] = False
+                if pos and m.start() == pos:
+                    # adjacent placeholders
+                    ok[0] = False
+                if '$' in lit[pos:m.start()] or '$' in m.group(1):
+                    ok[0] = False
+                if m.start() > pos:
+                    segments.append((Chunk.LITERAL, lit[pos:m.start()]))
+                segments.append((Chunk.VAR, m.group(1)))
+                textvars.append(m.group(1))
+                pos = m.end()
+            if '$' in lit[pos:]:
+                ok[0] = False
+            if pos < len(lit):
+                segments.append((Chunk.LITERAL, lit[pos:]))
+
+        pos = 0
+        for m in Cmd.syntax.findtokens('cmdsubst', text):
+            # each pasted cmd should have indent string, to indent tangled text later
+            indent = indentstr(text, m.start(0))
+            dep = Cmd.create_cmd(m.group(0), indent=indent)
+            try:
+                cm = Cmd.syntax.getcre('concrcmdsubst', path=dep.jpath()).match(text, m.start(0))
+            except re.error:
+                cm = None
+            if not cm or cm.end(0) != m.end(0):
+                # subcmd() will not substitute exactly this token
+                ok[0] = False
+            _addliteral(text[pos:m.start(0)], True)
+            segments.append((Chunk.PASTE, len(deps)))
+            deps.append(dep)
+            pos = m.end(0)
+        _addliteral(text[pos:], False)
+        unsafevars = set()
+        for textvar in set(textvars):
+            # str.replace() of subargs() will replace only these placeholders?
+            placeholder = '$' + textvar
+            if sum(lit.count(placeholder) for lit in literals) != textvars.count(textvar):
+                unsafevars.add(textvar)
+        self._template = ChunkTemplate(surr=surr, deps=deps, isdone=Chunk._isdone(text),
+                segments=segments, textvars=textvars, unsafevars=unsafevars,
+                simple=ok[0])
+        return self._template
+
+    def render(self, parser=None, posargs=(), kwargs={}, pastes=()):
+        """Set 'tangle' and 'isdone' from orig with substituted pastes (texts
+        for each of deps) and args. The same as subcmd() for each dep then
+        subargs() after reset, but in one pass on compiled orig
+
+        >>> c = Chunk('aaa $a <<=x.y, z>> $b $0')
+        >>> c.compile().simple, bool(c.compile().unsafevars)
+        (True, False)
+        >>> c.render(kwargs=dict(a=1), pastes=['zzz'], posargs=(7,))
+        False
+        >>> c.tangle
+        'aaa 1 zzz $b 7'
+        >>> c.render(kwargs=dict(a=1, b=2), pastes=['zzz'], posargs=(8,))
+        True
+        >>> c.tangle
+        'aaa 1 zzz 2 8'
+
+        Placeholder which is prefix of another one is replaced as in subargs()
+        (where order of replacing is not defined):
+        >>> c = Chunk('$a $ab')
+        >>> c.compile().simple, sorted(c.compile().unsafevars)
+        (True, ['a'])
+        >>> c.render(kwargs=dict(a=1, ab=2))
+        True
+        >>> c.tangle in ('1 1b', '1 2'), c.tangle == Chunk._subargs('$a $ab', kwargs=dict(a=1, ab=2))
+        (True, True)
+
+        Not simple cases are processed by subcmd(), subargs() (here var. name
+        continues in pasted text):
+        >>> c = Chunk('a $x<<=c.b>>')
+        >>> c.compile().simple
+        False
+        >>> c.render(kwargs=dict(x=1), pastes=['bbb'])
+        False
+        >>> c.tangle
+        'a $xbbb'
+        >>> c.render(kwargs=dict(x=1), pastes=[' bbb']), c.tangle
+        (True, 'a 1 bbb')
+        >>> c = Chunk('<<=x>>')
+        >>> c.render(pastes=[''])
+        False
+        >>> c.tangle
+        '<<=x>>'
+        """
+        template = self.compile()
+        text = None
+        if template.simple:
+            lead = template.surr[2] + '='
+            for content in pastes:
+                if '$' in content or '\\' in content or lead in content:
+                    break
+            else:
+                pieces = []
+                for kind, value in template.segments:
+                    if kind == Chunk.LITERAL: pieces.append(value)
+                    elif kind == Chunk.VAR: pieces.append('$' + value)
+                    else: pieces.append(pastes[value])
+                text = ''.join(pieces)
+                if lead in text or (not text and template.deps):
+                    # new pasted cmd or subargs() will use orig
+                    text = None
+        if text is None:
+            # usual (slow) way
+            text = self.orig if template.isdone else ''
+            for dep, content in zip(template.deps, pastes):
+                text = Chunk._subcmd(text or self.orig, dep.jpath(), content)
+            self.tangle = text
+            return self.subargs(parser=parser, posargs=posargs, kwargs=kwargs)
+
+        values = Chunk._varvalues(set(template.textvars), parser=parser,
+                posargs=posargs, kwargs=kwargs)
+        if any(v is not None and ('$' in v or textvar in template.unsafevars)
+                for textvar, v in values):
+            # replacing should be done as in subargs()
+            for textvar, v in values:
+                if v is not None:
+                    text = text.replace('$%s'%textvar, v)
+            self.tangle = text
+            return self.update_isdone()
+
+        values = dict(values)
+        pieces = []
+        nunresolved = 0
+        for kind, value in template.segments:
+            if kind == Chunk.LITERAL:
+                pieces.append(value)
+            elif kind == Chunk.VAR:
+                v = values[value]
+                if v is None:
+                    pieces.append('$' + value)
+                    if value[0] not in ' $':
+                        nunresolved += 1
+                else:
+                    pieces.append(v)
+            else:
+                pieces.append(pastes[value])
+        self.tangle = ''.join(pieces)
+        if template.surr[2] + '=' in self.tangle:
+            # values of vars can contain cmd. substitution
+            return self.update_isdone()
+        self.isdone = nunresolved == 0
+        return self.isdone
+
     def __len__(self):
         return len(self.orig)
 
@@ -1577,6 +2135,20 @@ class Chunk:
         >>> Chunk._subargs('Aaa $0 $1 b c $-1 $-2 $*', posargs=(10, 20))
         'Aaa 10 20 b c 20 10 1020'
         """
+        textvars = Chunk._varplaceholders_re.findall(text)
+        values = Chunk._varvalues(set(textvars), parser=parser, posargs=posargs,
+                kwargs=kwargs)
+        # substitute
+        for textvar, varvalue in values:
+            if varvalue is not None:
+                text = text.replace('$%s'%textvar, varvalue)
+        return text
+
+    @staticmethod
+    def _varvalues(textvars, parser=None, posargs=(), kwargs={}):
+        """Returns list of (textvar, value) for each var. placeholder (without
+        '$') of textvars, value is str or None if var can not be resolved
+        """
         def _varname(s):
             """Name of variable from it's placeholder in text -
             'xxx' -> 'xxx' and '{xxx}' -> 'xxx'
@@ -1630,17 +2202,12 @@ class Chunk:
                 argvalue = parser.getvar(argvalue)
                 kwargs[argname] = argvalue
 
-        # substitute
-        textvars = Chunk._varplaceholders_re.findall(text)
-        for textvar in set(textvars):
+        values = []
+        for textvar in textvars:
             varname = _varname(textvar)
-            #print 'Found textvar %s with name %s'%(textvar, varname)
             varvalue = _varvalue(varname, posargs, kwargs, novars, varsdict)
-            #print 't: %s, n:%s, v:%s, novars=%s'%(textvar, varname, varvalue, novars)
-            if varvalue is not None:
-                text = text.replace('$%s'%textvar, str(varvalue))
-            #print "So text is '%s'"%text
-        return text
+            values.append((textvar, None if varvalue is None else str(varvalue)))
+        return values
 
     def subargs(self, parser=None, posargs=(), kwargs={}):
         """Substitute arguments and set 'tangle' and 'isdone'
@@ -1745,25 +2312,225 @@ class Chunk:
             result.append(Cmd.create_cmd(txtdep.group(0), indent=indent))
         return result
 
-    def visit(self, walkid):
-        if self._walkid != walkid:
-            # new walk session
-            self._walkid = walkid
-            self._nvisits = 1
-        else:
-            # old walk session
-            self._nvisits += 1
-        return self._nvisits
-
 ################################################################################
 
 class ChunkDictError(Exception): pass
 
+class ChunkDictStreamError(ChunkDictError): pass
+
+class PathTrie:
+    """Trie of dotted paths (by components). Items of each node are kept
+    with sequence number of adding, so results can be ordered as added
+
+    >>> t = PathTrie()
+    >>> t.add('c.a', 'A'); t.add('c', 'C'); t.add('c.b.x', 'X'); t.add('d', 'D')
+    >>> t.find('c.a')
+    [(0, 'A')]
+    >>> t.find('c.x')
+    []
+    >>> sorted(t.subtree('c'))
+    [(0, 'A'), (1, 'C'), (2, 'X')]
+    >>> sorted(t.subtree(''))
+    [(0, 'A'), (1, 'C'), (2, 'X'), (3, 'D')]
+    >>> t.withlast('x')
+    [(2, 'X')]
+    """
+    def __init__(self):
+        # node is [children-dict, items-list]
+        self._root = [{}, []]
+        # {last-component: items-list}
+        self._bylast = {}
+        self._seq = 0
+
+    def _node(self, path, create=False):
+        if isinstance(path, StringTypes23):
+            path = path.split('.') if path else []
+        node = self._root
+        for comp in path:
+            children = node[0]
+            if comp not in children:
+                if not create: return None
+                children[comp] = [{}, []]
+            node = children[comp]
+        return node
+
+    def add(self, path, item):
+        if isinstance(path, StringTypes23):
+            path = path.split('.') if path else []
+        it = (self._seq, item)
+        self._node(path, create=True)[1].append(it)
+        if path:
+            self._bylast.setdefault(path[-1], []).append(it)
+        self._seq += 1
+
+    def withlast(self, comp):
+        """Returns items (seq, item) with last path component 'comp' (ordered)"""
+        return list(self._bylast.get(comp, ()))
+
+    def find(self, path):
+        """Returns items with exact path as list of (seq, item)"""
+        node = self._node(path)
+        return list(node[1]) if node else []
+
+    def subtree(self, path):
+        """Yields items (seq, item) with path and all below it (not ordered)"""
+        node = self._node(path)
+        if node is None: return
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            for it in node[1]:
+                yield it
+            stack.extend(node[0].values())
+
+    def children(self, path):
+        """Yields items (seq, item) with path one component deeper than 'path'"""
+        node = self._node(path)
+        if node is None: return
+        for child in node[0].values():
+            for it in child[1]:
+                yield it
+
+class ChunkKey(object):
+    """Immutable key of chunk in ChunkDict: path, args and body of Cmd (as
+    tuples) with precomputed hash. Keys are interned, so equal keys are the
+    same object usually, and they are equal only if all parts are equal
+
+    >>> k = ChunkKey.create(['c', 'f'], [('x', '1')], [])
+    >>> k is ChunkKey.create(('c', 'f'), (('x', '1'),), ())
+    True
+    >>> k == ChunkKey.create(['c', 'f'])
+    False
+    >>> k.jpath, k
+    ('c.f', ChunkKey('c.f'))
+    """
+    __slots__ = ('path', 'args', 'body', 'jpath', '_hash', '__weakref__')
+
+    ## {(path, args, body): ChunkKey} - alive keys
+    _interned = weakref.WeakValueDictionary()
+
+    def __init__(self, path, args, body):
+        self.path = path
+        self.args = args
+        self.body = body
+        self.jpath = '.'.join(path)
+        self._hash = hash((path, args, body))
+
+    @staticmethod
+    def create(path, args=(), body=()):
+        """Returns interned key"""
+        factors = (tuple(path), tuple(args), tuple(body))
+        key = ChunkKey._interned.get(factors)
+        if key is None:
+            key = ChunkKey(*factors)
+            ChunkKey._interned[factors] = key
+        return key
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, oth):
+        if self is oth:
+            return True
+        elif not isinstance(oth, ChunkKey) or self._hash != oth._hash:
+            return False
+        else:
+            return self.path == oth.path and self.args == oth.args \
+                    and self.body == oth.body
+
+    def __ne__(self, oth):
+        return not self == oth
+
+    def __repr__(self):
+        return 'ChunkKey(%r)'%self.jpath
+
+ExpCacheInfo = namedtuple('ExpCacheInfo', ['hits', 'misses', 'size'])
+
 class ChunkDict:
-    """Dictionary of chunks, where key is Cmd
+    """Dictionary of chunks, where key is ChunkKey of Cmd. Cmd (first
+    defined for the key) is kept as metadata of chunk
     """
+    ## {ChunkKey: Chunk}
+    chunks = None
+    ## {ChunkKey: Cmd}
+    cmds = None
+    ## {(jpath, posargs, kwargs, vars-version): (tangle, chunk.isdone, isdone)} -
+    ## memoized results of expand()
+    _expcache = None
+    ## counters of expand() cache hits/misses
+    _exphits = 0
+    _expmisses = 0
+    ## {jpath: (Cmd, Chunk)} - first defined chunk for each path
+    _index = None
+    ## {jpath-without-index: Cmd.SetInfo} - sizes of multiple parts sets
+    _setsinfo = None
+    ## PathTrie of all keys (for globpath())
+    _trie = None
+
+    ## chars which make path glob pattern
+    GLOBCHARS = '*?['
+
     def __init__(self):
         self.chunks = OrderedDict()
+        self.cmds = {}
+        self._index = {}
+        self._setsinfo = {}
+        self._trie = PathTrie()
+        self._expcache = {}
+        self._exphits = 0
+        self._expmisses = 0
+
+    def _addindex(self, cmd, chunk, isnew):
+        """Add just registered cmd to index (first definition of path wins),
+        isnew is False if key was already in dict (only chunk is replaced)
+        """
+        if isnew:
+            self._trie.add(cmd.path, cmd)
+        jpath = cmd.jpath()
+        indexed = self._index.get(jpath)
+        if indexed is None:
+            self._index[jpath] = (cmd, chunk)
+        elif indexed[0].key() == cmd.key():
+            # the same key of self.chunks, only chunk is replaced
+            self._index[jpath] = (indexed[0], chunk)
+        if Cmd.pathindex(cmd.path) == 0:
+            self._setsinfo.setdefault('.'.join(cmd.path[:-1]), cmd.setinfo)
+
+    def invalidate(self):
+        """Drop memoized results of expand(). Is called when chunks or vars
+        are changed
+        """
+        self._expcache.clear()
+
+    def expcache_info(self):
+        """Returns ExpCacheInfo(hits, misses, size) of expand() cache
+
+        >>> cd = ChunkDict()
+        >>> cd.define_chunk(Cmd.create_cmd('<<c.a>>'), Chunk('<<=c.b>> <<=c.b>>'))
+        True
+        >>> cd.define_chunk(Cmd.create_cmd('<<c.b>>'), Chunk('bbb'))
+        True
+        >>> cd.expand('c.a')
+        True
+        >>> cd.expcache_info()
+        ExpCacheInfo(hits=1, misses=2, size=2)
+        >>> cd.define_chunk(Cmd.create_cmd('<<c.c>>'), Chunk('ccc'))
+        True
+        >>> cd.expcache_info()
+        ExpCacheInfo(hits=1, misses=2, size=0)
+        """
+        return ExpCacheInfo(self._exphits, self._expmisses, len(self._expcache))
+
+    @staticmethod
+    def _expkey(jpath, parser, posargs, kwargs):
+        """Key of expand() cache or None if args are unhashable"""
+        version = (id(parser), parser.varsversion) if parser else None
+        key = (jpath, tuple(posargs), tuple(sorted(kwargs.items())), version)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
 
     def __len__(self):
         return len(self.chunks)
@@ -1780,9 +2547,9 @@ class ChunkDict:
         >>> cd2.define_chunk(Cmd.create_cmd('<<c.abs>>'), Chunk('x + y'))
         True
         >>> cd1.merge(cd2, 'a.b')
-        >>> Cmd.create_cmd('<<c.abs>>') in cd1.chunks
+        >>> Cmd.create_cmd('<<c.abs>>').key() in cd1.chunks
         False
-        >>> Cmd.create_cmd('<<a.b.c.abs>>') in cd1.chunks
+        >>> Cmd.create_cmd('<<a.b.c.abs>>').key() in cd1.chunks
         True
         >>> cd3 = ChunkDict()
         >>> cd3.define_chunk(Cmd.create_cmd('<<c.sum>>'), Chunk('x + y'))
@@ -1794,12 +2561,16 @@ class ChunkDict:
         >>> cd1.merge(cd3, 'x')
         """
         #print 'Try to merge %s'%', '.join(p.jpath() for p in othchunkdict.chunks.keys())
-        for cmd, chunk in othchunkdict.chunks.items():
+        for cmd, chunk in othchunkdict.items():
             cmd.setpath(prefix=path)
-            if cmd in self.chunks:
+            key = cmd.key()
+            if key in self.chunks:
                 raise ChunkDictError("'%s' path already exists when merging" % \
                         cmd.jpath())
-            self.chunks[cmd] = chunk
+            self.chunks[key] = chunk
+            self.cmds[key] = cmd
+            self._addindex(cmd, chunk, True)
+        self.invalidate()
 
     def define_chunk(self, cmd, chunk):
         """Register chunk with name/header as cmd
@@ -1807,29 +2578,41 @@ class ChunkDict:
         >>> cd = ChunkDict()
         >>> cd.define_chunk(Cmd.create_cmd('<<c.sum>>'), Chunk('x + y'))
         True
-        >>> Cmd.create_cmd('<<c.sum>>') in cd.chunks
+        >>> Cmd.create_cmd('<<c.sum>>').key() in cd.chunks
         True
         """
-        self.chunks[cmd] = chunk
+        key = cmd.key()
+        isnew = key not in self.chunks
+        self.chunks[key] = chunk
+        if isnew:
+            self.cmds[key] = cmd
+        else:
+            # first defined Cmd is kept
+            cmd = self.cmds[key]
+        self._addindex(cmd, chunk, isnew)
+        self.invalidate()
         return True
 
-    def __askey(self, something):
+    def __asjpath(self, something):
+        """Returns jpath of Cmd or of path text (with normalized negative index)
+        or None"""
         if isinstance(something, Cmd):
-            return something
+            return something.jpath()
         elif isinstance(something, StringTypes23):
-            cmd = Cmd.create_cmd(something)
-            index = Cmd.pathindex(cmd.path)
+            # parsed text is memoized, Cmd is not needed
+            path = Cmd.getheader(something).path
+            index = Cmd.pathindex(path)
             if index is None or index >= 0:
                 # not indexed or index is positive
-                return cmd
+                return '.'.join(path)
             else:
-                # else cmd is with negative index, so do:
-                # - find command (cmd0) with the same path but index 0
-                # - cmd0 knows about set cmd1...cmdN and normalizes negative index
-                # - returns command with normalized path
-                try: cmd0,_ = self.getbypath(Cmd.changepathindex(cmd.path, 0)) # get xxx.0
-                except KeyError: raise KeyError(cmd.jpath()) # no such command!
-                return self.getbypath(cmd0.normpathindex(cmd.path))[0]
+                # else cmd is with negative index, so normalize it with size of
+                # set xxx.0...xxx.N
+                setinfo = self._setsinfo.get('.'.join(path[:-1]))
+                if setinfo is None: raise KeyError('.'.join(path)) # no such command!
+                index = normnegindex(index, setinfo.size)
+                if index is None: raise KeyError('.'.join(path))
+                return Cmd.changepathindex(list(path), index)
         else:
             return None
 
@@ -1872,11 +2655,38 @@ class ChunkDict:
         ['c', 'c.sum', 'c.abs', 'd.defs']
         >>> cd.globpath('*.', _onlypath=True)
         []
+        >>> cd.globpath('c*', _onlypath=True)
+        ['c', 'c.sum', 'c.abs']
+        >>> cd.globpath('?.abs', _onlypath=True)
+        ['c.abs']
         """
-        found = []
-        for cmd in self.chunks.keys():
-            if cmd.matchpath(gpath):
-                found.append(cmd)
+        comps = gpath.split('.')
+        negindex = (Cmd.pathindex(comps) or 0) < 0
+        # number of leading components without glob chars
+        nliteral = 0
+        for comp in comps:
+            if any(ch in comp for ch in self.GLOBCHARS): break
+            nliteral += 1
+        # candidates from trie, then they are matched as usual
+        if nliteral == len(comps):
+            if not negindex:
+                candidates = self._trie.find(comps)
+            else:
+                # each set member normalizes negative index itself
+                candidates = self._trie.children(comps[:-1])
+        elif nliteral > 0:
+            candidates = self._trie.subtree(comps[:nliteral])
+        elif len(comps) > 1 and not negindex and '[' not in gpath and \
+                not any(ch in comps[-1] for ch in self.GLOBCHARS):
+            candidates = self._trie.withlast(comps[-1])
+        else:
+            candidates = self._trie.subtree('')
+        candidates = sorted(candidates, key=lambda it: it[0])
+        if negindex:
+            found = [cmd for _,cmd in candidates if cmd.matchpath(gpath)]
+        else:
+            cre = Cmd.globre(gpath)
+            found = [cmd for _,cmd in candidates if cre.match(cmd.jpath())]
         if _onlypath:
             return [f.jpath() for f in found]
         else:
@@ -1898,18 +2708,22 @@ class ChunkDict:
             ...
         KeyError: 'aaa'
         """
-        _key = self.__askey(key)
-        if _key is None:
+        jpath = self.__asjpath(key)
+        if jpath is None:
+            raise KeyError(key)
+        try:
+            return self._index[jpath]
+        except KeyError:
             raise KeyError(key)
-        else:
-            for k,v in self.chunks.items():
-                if k == _key:
-                    return (k, v)
-        raise KeyError(key)
 
     def getbykey(self, cmd):
         """Returns chunk by Cmd key"""
-        return self.chunks[cmd]
+        return self.chunks[cmd.key()]
+
+    def items(self):
+        """Returns (Cmd, Chunk) pairs in order of definition"""
+        cmds = self.cmds
+        return [(cmds[key], chunk) for key, chunk in self.chunks.items()]
 
     def keys(self, **attrs):
         """Returns Cmd (keys) matched by it's attrs (or all if no attrs)
@@ -1923,13 +2737,15 @@ class ChunkDict:
         >>> [c.jpath() for c in l]
         ['c.sum']
         """
+        cmds = self.cmds
         if attrs:
-            for cmd in self.chunks.keys():
+            for key in self.chunks.keys():
+                cmd = cmds[key]
                 if all(getattr(cmd, attr)==attrs[attr] for attr in attrs):
                     yield cmd
         else:
-            for cmd in self.chunks.keys():
-                yield cmd
+            for key in self.chunks.keys():
+                yield cmds[key]
 
     def __contains__(self, key):
         """Test of existent
@@ -1939,29 +2755,169 @@ class ChunkDict:
         True
         >>> 'c.sum' in cd
         True
+        >>> 'c.sum.-1' in cd
+        False
         """
-        key = self.__askey(key)
-        if key is None:
+        try:
+            jpath = self.__asjpath(key)
+        except KeyError:
+            return False
+        if jpath is None:
             return False
         else:
-            return key in self.chunks
+            return jpath in self._index
 
-    # Seems that not work
-    def check_cycle(self, cmd, walkid):
-        """Check are any cycles, returns True if there are, False else
+    def depsgraph(self):
+        """Returns dependencies graph as list of (Cmd, [index-of-dep-Cmd...]),
+        where index is position in this list. Glob pastes like '<<=c.*>>' are
+        expanded to all matched Cmd's, unknown pastes are ignored
+
+        >>> cd = ChunkDict()
+        >>> cd.define_chunk(Cmd.create_cmd('<<c>>'), Chunk('<<=c.*>> <<=x>>'))
+        True
+        >>> cd.define_chunk(Cmd.create_cmd('<<c.a>>'), Chunk('a'))
+        True
+        >>> cd.define_chunk(Cmd.create_cmd('<<c.b>>'), Chunk('<<=c.a>>'))
+        True
+        >>> [(c.jpath(), d) for c, d in cd.depsgraph()]
+        [('c', [1, 2]), ('c.a', []), ('c.b', [1])]
         """
-        chunk = self.chunks[cmd]
-        if chunk.visit(walkid) > 1:
-            return True
-        for dep in chunk.deps:
-            if dep in self.chunks:
-                if self.check_cycle(dep, walkid):
-                    return True
-        return False
+        items = self.items()
+        indexes = dict((id(cmd), i) for i, (cmd, _) in enumerate(items))
+        graph = []
+        for cmd, chunk in items:
+            edges = []
+            for dep in chunk.deps:
+                for depcmd in self.globpath(dep.jpath()):
+                    idep = indexes[id(depcmd)]
+                    if idep not in edges:
+                        edges.append(idep)
+            graph.append((cmd, edges))
+        return graph
+
+    def plainorder(self, roots):
+        """Returns Cmd's which are reachable from roots (list of Cmd) via
+        dependencies without args, in reverse topological order (dependencies
+        first, roots are included). They are expanded with the same (empty)
+        args, so results of expanding are shared
+
+        >>> cd = ChunkDict()
+        >>> cd.define_chunk(Cmd.create_cmd('<<f1>>'), Chunk('<<=h>> <<=c.*>>'))
+        True
+        >>> cd.define_chunk(Cmd.create_cmd('<<f2>>'), Chunk('<<=h>> <<=x, a:1>>'))
+        True
+        >>> cd.define_chunk(Cmd.create_cmd('<<h>>'), Chunk('<<=c.a>>'))
+        True
+        >>> cd.define_chunk(Cmd.create_cmd('<<c.a>>'), Chunk('a'))
+        True
+        >>> cd.define_chunk(Cmd.create_cmd('<<c.b>>'), Chunk('b'))
+        True
+        >>> cd.define_chunk(Cmd.create_cmd('<<x>>'), Chunk('x $a'))
+        True
+        >>> roots = [cd.getbypath('f1')[0], cd.getbypath('f2')[0]]
+        >>> [c.jpath() for c in cd.plainorder(roots)]
+        ['c.a', 'h', 'c.b', 'f1', 'f2']
+        """
+        order = []
+        state = {} # id(Cmd): False - in progress, True - done
+        for root in roots:
+            if id(root) in state:
+                continue
+            state[id(root)] = False
+            work = [(root, iter(self.plaindeps(root)))]
+            while work:
+                cmd, deps = work[-1]
+                for dep in deps:
+                    if id(dep) not in state:
+                        state[id(dep)] = False
+                        work.append((dep, iter(self.plaindeps(dep))))
+                        break
+                else:
+                    work.pop()
+                    state[id(cmd)] = True
+                    order.append(cmd)
+        return order
+
+    def plaindeps(self, cmd):
+        """Returns Cmd's of dependencies of cmd without args (Cmd are keys)"""
+        ret = []
+        for dep in self.getbykey(cmd).deps:
+            if not dep.args and not dep.body:
+                ret.extend(self.globpath(dep.jpath()))
+        return ret
+
+    def find_cycles(self):
+        """Returns all cycles as list of lists of Cmd (in order of definition).
+        Uses Tarjan's strongly connected components algorithm (without
+        recursion), so each node and edge is visited once
+
+        >>> cd = ChunkDict()
+        >>> cd.define_chunk(Cmd.create_cmd('<<c.a>>'), Chunk('aaa <<=c.b>> bbb'))
+        True
+        >>> cd.define_chunk(Cmd.create_cmd('<<c.b>>'), Chunk('<<=c.a>>'))
+        True
+        >>> cd.define_chunk(Cmd.create_cmd('<<c.c>>'), Chunk('<<=c.a>>'))
+        True
+        >>> cd.define_chunk(Cmd.create_cmd('<<d>>'), Chunk('<<=d*>>'))
+        True
+        >>> [[c.jpath() for c in cycle] for cycle in cd.find_cycles()]
+        [['c.a', 'c.b'], ['d']]
+        """
+        graph = self.depsgraph()
+        nodeindex = [None] * len(graph) # order of visiting
+        lowlink = [0] * len(graph)
+        onstack = [False] * len(graph)
+        stack = []
+        sccs = []
+        counter = 0
+        for root in range(len(graph)):
+            if nodeindex[root] is not None:
+                continue
+            # each item of work is (node, position in it's edges list)
+            work = [(root, 0)]
+            while work:
+                node, iedge = work.pop()
+                if iedge == 0:
+                    nodeindex[node] = lowlink[node] = counter
+                    counter += 1
+                    stack.append(node)
+                    onstack[node] = True
+                edges = graph[node][1]
+                recurse = False
+                while iedge < len(edges):
+                    dep = edges[iedge]
+                    iedge += 1
+                    if nodeindex[dep] is None:
+                        # visit dep, then continue with node
+                        work.append((node, iedge))
+                        work.append((dep, 0))
+                        recurse = True
+                        break
+                    elif onstack[dep]:
+                        lowlink[node] = min(lowlink[node], nodeindex[dep])
+                if recurse:
+                    continue
+                if lowlink[node] == nodeindex[node]:
+                    # node is root of SCC
+                    scc = []
+                    while True:
+                        member = stack.pop()
+                        onstack[member] = False
+                        scc.append(member)
+                        if member == node:
+                            break
+                    if len(scc) > 1 or node in graph[node][1]:
+                        sccs.append(sorted(scc))
+                if work:
+                    # return to caller node
+                    caller = work[-1][0]
+                    lowlink[caller] = min(lowlink[caller], lowlink[node])
+        sccs.sort()
+        return [[graph[i][0] for i in scc] for scc in sccs]
 
     def check_cycles(self):
         """Check cycles in all registered chunks. If there are some cycles, raise
-        ChunkDictError
+        ChunkDictError with all of them (with source files, if they are known)
 
         >>> cd = ChunkDict()
         >>> cd.define_chunk(Cmd.create_cmd('<<c.a>>'), Chunk('aaa <<=c.b>> bbb'))
@@ -1972,12 +2928,25 @@ class ChunkDict:
         >>> cd.check_cycles()
         Traceback (most recent call last):
             ...
-        ChunkDictError: cyclic 'c.a'
+        ChunkDictError: cyclic 'c.a', 'c.b'
+        >>> cd.define_chunk(Cmd.create_cmd('<<c.x>>'), Chunk('<<=c.x>>'))
+        True
+        >>> cd.getbypath('c.x')[0].srcinfo.infile = 'x.md'
+        >>> cd.check_cycles()
+        Traceback (most recent call last):
+            ...
+        ChunkDictError: cyclic 'c.a', 'c.b'; cyclic 'c.x' (x.md)
         """
-        for cmd in self.chunks.keys():
-            walkid = random.randint(0,32768) #os.urandom(8)
-            if self.check_cycle(cmd, walkid):
-                raise ChunkDictError("cyclic '%s'"%cmd.jpath())
+        def _member(cmd):
+            infile = cmd.srcinfo.infile
+            if infile:
+                return "'%s' (%s)" % (cmd.jpath(), Uri(infile).getmoniker())
+            else:
+                return "'%s'" % cmd.jpath()
+        cycles = self.find_cycles()
+        if cycles:
+            raise ChunkDictError('; '.join('cyclic ' + ', '.join(_member(cmd)
+                for cmd in cycle) for cycle in cycles))
 
     def expand(self, path, visited=None, parser=None, posargs=(), kwargs={}):
         """Try to expand all '<<=...>>' holders
@@ -2017,61 +2986,376 @@ class ChunkDict:
         Traceback (most recent call last):
             ...
         ChunkDictError: cyclic ...
-        """
 
-        if visited is None:
-            visited = []
+        Results are memoized by path, args and vars version:
+        >>> cd = ChunkDict()
+        >>> cd.define_chunk(Cmd.create_cmd('<<c.a>>'), Chunk('<<=c.b, x:1>> <<=c.b, x:2>> <<=c.b, x:1>>'))
+        True
+        >>> cd.define_chunk(Cmd.create_cmd('<<c.b>>'), Chunk('b$x'))
+        True
+        >>> cd.expand('c.a')
+        True
+        >>> cd.getbypath('c.a')[1].tangle
+        'b1 b2 b1'
+        >>> cd.expcache_info()
+        ExpCacheInfo(hits=1, misses=3, size=3)
+
+        Expanding is iterative (no recursion), so chains of pastes can be
+        deeper than recursion limit:
+        >>> cd = ChunkDict()
+        >>> for i in range(3000):
+        ...     _ = cd.define_chunk(Cmd.create_cmd('<<c.n%d>>'%i), Chunk('<<=c.n%d>>'%(i+1)))
+        >>> cd.define_chunk(Cmd.create_cmd('<<c.n3000>>'), Chunk('end'))
+        True
+        >>> cd.expand('c.n0'), cd.getbypath('c.n0')[1].tangle
+        (True, 'end')
+        """
+        visited = set(visited or ())
+        # frames of chunks being expanded (instead of recursion)
+        stack = []
 
-        # normalize path with negative index first
-        cmd, chunk = self.getbypath(path)
+        def _enter(path, posargs, kwargs):
+            """Start expanding of path: returns isdone if result is known
+            (memoized), otherwise pushes new frame and returns None
+            """
+            # normalize path with negative index first
+            cmd, chunk = self.getbypath(path)
+            jpath = cmd.jpath()
+            if jpath in visited:
+                raise ChunkDictError("cyclic '%s'"%jpath)
+            # key is got before kwargs are changed by subargs()
+            key = self._expkey(jpath, parser, posargs, kwargs)
+            if key is not None and key in self._expcache:
+                self._exphits += 1
+                chunk.tangle, chunk.isdone, isdone = self._expcache[key]
+                return isdone
+            self._expmisses += 1
+            if not stack:
+                # top-level chunk may keep tangle from previous expanding
+                chunk._reset()
+            visited.add(jpath)
+            stack.append(dict(cmd=cmd, chunk=chunk, jpath=jpath, key=key,
+                posargs=posargs, kwargs=kwargs, deps=iter(chunk.deps), dep=None,
+                depcmds=iter(()), repls=[], pastes=[], depsaredone=True,
+                pending=None))
+            return None
 
-        jpath = cmd.jpath()
-        if jpath in visited:
-            raise ChunkDictError("cyclic '%s'"%jpath)
-
-        visited.append(jpath)
-        depsaredone = True
-        for dep in chunk.deps:
-            # over dependencies as Cmd (<<=dep>> - dep may be glob path)
-            globpath = dep.jpath() # glob path or usual path
-            joinkw = dep.getarg('join', '') # dep can have 'join' arg
+        def _leave(frame):
+            """Finish expanding of frame chunk, returns isdone"""
+            cmd, chunk = frame['cmd'], frame['chunk']
+            # paste and extend kwargs (total result is chunk.isdone)
+            if parser:
+                parser.trapevent(cmd, 'subargs')
+            chunk.render(parser=parser, posargs=frame['posargs'],
+                    kwargs=frame['kwargs'], pastes=frame['pastes'])
+            visited.discard(frame['jpath'])
+            isdone = frame['depsaredone'] and chunk.isdone
+            if isdone and parser:
+                chunk.tangle = parser.emitevent(cmd, 'paste', parser=parser,
+                        chunktext=chunk.tangle)['chunktext']
+            if frame['key'] is not None:
+                self._expcache[frame['key']] = (chunk.tangle, chunk.isdone, isdone)
+            return isdone
+
+        isdone = _enter(path, posargs, kwargs)
+        while stack:
+            frame = stack[-1]
+            if frame['pending'] is not None:
+                # isdone is result of expanding of pending dependency
+                depchunk, startkw, endkw = frame['pending']
+                frame['pending'] = None
+                if isdone:
+                    # if dep is done or was sucessfully expanded, keep it in repls
+                    frame['repls'].append(startkw + depchunk.tangle + endkw)
+                else:
+                    # impossible to extend now, so skip this depend
+                    frame['depsaredone'] = False
+            # next Cmd of current dependency (glob path may give several)
+            depcmd = next(frame['depcmds'], None)
+            while depcmd is None:
+                dep = frame['dep']
+                if dep is not None:
+                    # join repls and substitute with it WITH INDENT
+                    joinkw = dep.getarg('join', '') # dep can have 'join' arg
+                    frame['pastes'].append(indenttext(joinkw.join(frame['repls']), dep.indent))
+                # over dependencies as Cmd (<<=dep>> - dep may be glob path)
+                dep = frame['dep'] = next(frame['deps'], None)
+                if dep is None:
+                    break
+                globpath = dep.jpath() # glob path or usual path
+                depcmds = self.globpath(globpath) # one or several Cmd's
+                if not depcmds:
+                    raise KeyError(globpath)
+                frame['depcmds'] = iter(depcmds)
+                frame['repls'] = [] # tangles of glob paths
+                depcmd = next(frame['depcmds'])
+            if depcmd is None:
+                # all dependencies are processed
+                stack.pop()
+                isdone = _leave(frame)
+                continue
+            dep = frame['dep']
+            # how depend is registered in dict:
+            depchunk = self.getbykey(depcmd)
+            depchunk._reset()
             startkw = dep.getarg('start', '') # also 'start' arg
             endkw = dep.getarg('end', '') # also 'end' arg
-            deps = self.globpath(globpath) # one or several Cmd's
-            if not deps:
-                raise KeyError(globpath)
-            repls = [] # replace with joined items of this list (tangles of glob paths)
-            for depcmd in deps:
-                # how depend is registered in dict:
-                deppath = depcmd.jpath()
-                depchunk = self.getbykey(depcmd)
-                depchunk._reset()
-                _posargs = posargs if not dep.body else dep.body # not copy bcz won't change
-                _kwargs = kwargs.copy()
-                _kwargs.update(dep.args)
-                #print '>', deppath, visited, parser, _posargs, _args
-                if not self.expand(deppath, visited=visited, parser=parser, posargs=_posargs, kwargs=_kwargs):
-                    # impossible to extend now, so skip this depend
-                    depsaredone = False
-                    continue
-
-                # if dep is done or was sucessfully expanded, keep it in repls
-                repls.append(startkw + depchunk.tangle + endkw)
-                #print '>>', depchunk.tangle, repls, '<<'
-            # join repls and substitute with it WITH INDENT
-            repltext = indenttext(joinkw.join(repls), dep.indent)
-            chunk.subcmd(globpath, repltext)
-        # extend kwargs (total result is chunk.isdone)
-        if parser:
-            parser.trapevent(cmd, 'subargs')
-        chunk.subargs(parser=parser, posargs=posargs, kwargs=kwargs)
-        visited.pop()
-        isdone = depsaredone and chunk.isdone
-        if isdone and parser:
-            chunk.tangle = parser.emitevent(cmd, 'paste', parser=parser,
-                    chunktext=chunk.tangle)['chunktext']
+            frame['pending'] = (depchunk, startkw, endkw)
+            _posargs = frame['posargs'] if not dep.body else dep.body # not copy bcz won't change
+            _kwargs = frame['kwargs'].copy()
+            _kwargs.update(dep.args)
+            isdone = _enter(depcmd.jpath(), _posargs, _kwargs)
         return isdone
 
+    @staticmethod
+    def _haspastehandlers(cmd, parser=None):
+        """Can 'paste' event change tangle of cmd chunk"""
+        if not parser:
+            return False
+        if getattr(cmd, '__onpaste__', None) or \
+                getattr(cmd.__class__, 'onpaste', None) != Cmd.onpaste:
+            return True
+        if any(argname.startswith('do.') for argname, _ in cmd.args):
+            return True
+        return any(h.canhandle(cmd, 'paste') for h in parser.handlers)
+
+    def iterexpand(self, path, parser=None, posargs=(), kwargs={}):
+        """Generator of fragments of expanded path text: joined fragments are
+        the same as chunk tangle after successful expand(), but whole texts of
+        chunks are not kept - literals, values of vars and pasted texts (indented
+        line by line) are yielded while expanding. Chunks with 'paste' handlers
+        or not simple templates are expanded by expand(). Pasted text with
+        escapes (it's re template, see Chunk._subcmd()) is kept until the end
+        of paste, then it's escapes are expanded. If the same result is
+        not guaranteed (or text can not be expanded), ChunkDictStreamError is
+        raised, then expand() should be used
+
+        >>> cd = ChunkDict()
+        >>> cd.define_chunk(Cmd.create_cmd('<<c.a>>'), Chunk('a:\\n  <<=c.b.*, x:1, join:\\,>>;'))
+        True
+        >>> cd.define_chunk(Cmd.create_cmd('<<c.b.x>>'), Chunk('b$x\\nbb'))
+        True
+        >>> cd.define_chunk(Cmd.create_cmd('<<c.b.y>>'), Chunk('B'))
+        True
+        >>> text = ''.join(cd.iterexpand('c.a'))
+        >>> text
+        'a:\\n  b1\\n  bb,B;'
+        >>> cd.expand('c.a'), cd.getbypath('c.a')[1].tangle == text
+        (True, True)
+        >>> cd.define_chunk(Cmd.create_cmd('<<c.main>>'), Chunk('int main() {\\n    <<=c.body>>\\n}'))
+        True
+        >>> cd.define_chunk(Cmd.create_cmd('<<c.body>>'), Chunk('printf("%d\\\\\\\\n", $x);\\nreturn 0;'))
+        True
+        >>> text = ''.join(cd.iterexpand('c.main', kwargs=dict(x='1')))
+        >>> print(text)
+        int main() {
+            printf("%d\\n", 1);
+            return 0;
+        }
+        >>> cd.expand('c.main', kwargs=dict(x='1')), cd.getbypath('c.main')[1].tangle == text
+        (True, True)
+        >>> cd.define_chunk(Cmd.create_cmd('<<c.h>>'), Chunk('<<=c.b.*, x:1, join:;\\\\n>>;'))
+        True
+        >>> ''.join(cd.iterexpand('c.h'))
+        'b1\\nbb;\\nB;'
+        >>> cd.define_chunk(Cmd.create_cmd('<<c.d>>'), Chunk('<<=c.b.x>> $y'))
+        True
+        >>> list(cd.iterexpand('c.d')) # doctest:+ELLIPSIS
+        Traceback (most recent call last):
+            ...
+        ChunkDictStreamError: ...
+
+        '$' of pasted text is kept only at the end of chunk, otherwise it can
+        form var. placeholder with the next text:
+        >>> cd.define_chunk(Cmd.create_cmd('<<c.dollar>>'), Chunk('$$ '))
+        True
+        >>> cd.define_chunk(Cmd.create_cmd('<<c.f>>'), Chunk('f <<=c.dollar>>'))
+        True
+        >>> ''.join(cd.iterexpand('c.f'))
+        'f $$ '
+        >>> cd.define_chunk(Cmd.create_cmd('<<c.e>>'), Chunk('<<=c.dollar>>$v'))
+        True
+        >>> cd.expand('c.e', kwargs=dict(v='V')), cd.getbypath('c.e')[1].tangle
+        (False, '$$ $v')
+        >>> ''.join(cd.iterexpand('c.e', kwargs=dict(v='V'))) # doctest:+ELLIPSIS
+        Traceback (most recent call last):
+            ...
+        ChunkDictStreamError: ...
+        """
+        lead = Cmd.syntax.getsurr()[2] + '='
+        visited = set()
+        # frames of streamed chunks (instead of recursion)
+        stack = []
+        # end of yielded text: to find lead splitted between fragments
+        tail = ['']
+
+        def _enter(path, posargs, kwargs, depcmd=None):
+            """Push frame for streaming of path and returns None or returns
+            text of chunk, expanded by expand()
+            """
+            cmd, chunk = self.getbypath(path)
+            if depcmd is not None and self.getbykey(depcmd) is not chunk:
+                raise ChunkDictStreamError("'%s' is defined several times"%path)
+            jpath = cmd.jpath()
+            if jpath in visited:
+                raise ChunkDictError("cyclic '%s'"%jpath)
+            template = chunk.compile()
+            if not template.simple or template.unsafevars or \
+                    ChunkDict._haspastehandlers(cmd, parser):
+                if not self.expand(path, visited=visited, parser=parser,
+                        posargs=posargs, kwargs=kwargs):
+                    raise ChunkDictStreamError("'%s' can not be expanded"%jpath)
+                return chunk.tangle
+            if parser:
+                parser.trapevent(cmd, 'subargs')
+            # kwargs of chunk are not changed, they are used by pasted chunks
+            values = dict(Chunk._varvalues(set(template.textvars), parser=parser,
+                    posargs=posargs, kwargs=kwargs.copy()))
+            if any(v is not None and '$' in v for v in values.values()):
+                raise ChunkDictStreamError("'%s' can not be streamed"%jpath)
+            visited.add(jpath)
+            stack.append(dict(jpath=jpath, orig=chunk.orig, template=template,
+                values=values, posargs=posargs, kwargs=kwargs,
+                segs=iter(template.segments), dep=None, depindex=None,
+                depcmds=None, indenter=None, pasted=None, nrepls=0, endkw='',
+                nonempty=False, dollar=False))
+            return None
+
+        def _checkvars(text, level):
+            """'$' of text pasted to stack[level] chunk is kept if it's not var.
+            placeholder (see Chunk._isdone()), otherwise raises ChunkDictStreamError
+            """
+            if '$' in text and (text.endswith('$') or next(Cmd.syntax.findtokens(
+                    'argsubst', text), UNDEFINED) is not UNDEFINED):
+                raise ChunkDictStreamError("'%s' can not be streamed"%stack[level]['jpath'])
+
+        def _paste(level):
+            """Returns kept pasted text of stack[level] chunk: it's re template
+            of pasted cmd. match (escapes are expanded) as in Chunk._subcmd()
+            """
+            frame = stack[level]
+            text = ''.join(frame['pasted'])
+            frame['pasted'] = None
+            orig = frame['orig']
+            m = list(Cmd.syntax.findtokens('cmdsubst', orig))[frame['depindex']]
+            m = Cmd.syntax.getcre('concrcmdsubst', path=frame['dep'].jpath()).match(orig, m.start(0))
+            try:
+                text = m.expand(text)
+            except re.error:
+                raise ChunkDictStreamError("'%s' can not be streamed"%frame['jpath'])
+            _checkvars(text, level)
+            return text
+
+        def _out(text, level, pasted=False):
+            """Text is part of text of stack[level] chunk (pasted to it if
+            pasted, or pasted text if level is len(stack)), returns fragment of
+            result text
+            """
+            while True:
+                if text and level < len(stack):
+                    frame = stack[level]
+                    if frame['dollar']:
+                        # expand() substitutes vars after pasting, so '$' of
+                        # pasted text and this text can be var. placeholder
+                        raise ChunkDictStreamError("'%s' can not be streamed"%frame['jpath'])
+                    frame['nonempty'] = True
+                    frame['dollar'] = pasted and '$' in text
+                if not level:
+                    break
+                level -= 1
+                pasted = True
+                # pasted text goes through parent chunk
+                _checkvars(text, level)
+                frame = stack[level]
+                text = frame['indenter'].feed(text)
+                if frame['pasted'] is not None or '\\' in text:
+                    # escapes can be splitted between fragments, so pasted text
+                    # is kept until end of paste (see _paste())
+                    frame['pasted'] = frame['pasted'] or []
+                    frame['pasted'].append(text)
+                    return ''
+            s = tail[0] + text
+            if lead in s:
+                # cmd. substitution in result text
+                raise ChunkDictStreamError("'%s' can not be streamed"%stack[0]['jpath'])
+            tail[0] = s[1-len(lead):]
+            return text
+
+        text = _enter(path, posargs, kwargs)
+        if text:
+            yield text
+        while stack:
+            frame = stack[-1]
+            level = len(stack) - 1
+            if frame['depcmds'] is not None:
+                # next Cmd of current dependency (glob path may give several)
+                depcmd = next(frame['depcmds'], None)
+                if depcmd is None:
+                    frame['depcmds'] = None
+                    if frame['pasted'] is not None:
+                        text = _out(_paste(level), level, pasted=True)
+                        if text:
+                            yield text
+                    continue
+                dep = frame['dep']
+                texts = []
+                if frame['nrepls']:
+                    texts.append(dep.getarg('join', ''))
+                frame['nrepls'] += 1
+                texts.append(dep.getarg('start', ''))
+                frame['endkw'] = dep.getarg('end', '')
+                self.getbykey(depcmd)._reset()
+                _posargs = frame['posargs'] if not dep.body else dep.body
+                _kwargs = frame['kwargs'].copy()
+                _kwargs.update(dep.args)
+                for text in texts:
+                    text = _out(text, level + 1)
+                    if text:
+                        yield text
+                text = _enter(depcmd.jpath(), _posargs, _kwargs, depcmd)
+                if text is not None:
+                    for text in (text, frame['endkw']):
+                        text = _out(text, level + 1)
+                        if text:
+                            yield text
+                continue
+            seg = next(frame['segs'], None)
+            if seg is None:
+                # all segments are processed
+                if frame['template'].deps and not frame['nonempty']:
+                    raise ChunkDictStreamError("'%s' can not be streamed"%frame['jpath'])
+                visited.discard(frame['jpath'])
+                stack.pop()
+                if stack:
+                    text = _out(stack[-1]['endkw'], len(stack))
+                    if text:
+                        yield text
+                continue
+            kind, value = seg
+            if kind == Chunk.LITERAL:
+                text = value
+            elif kind == Chunk.VAR:
+                frame['nonempty'] = True
+                text = frame['values'][value]
+                if text is None:
+                    if value[0] not in ' $':
+                        raise ChunkDictStreamError("'%s' can not be expanded"%frame['jpath'])
+                    text = '$' + value
+            else:
+                dep = frame['dep'] = frame['template'].deps[value]
+                frame['depindex'] = value
+                globpath = dep.jpath() # glob path or usual path
+                depcmds = self.globpath(globpath) # one or several Cmd's
+                if not depcmds:
+                    raise KeyError(globpath)
+                frame['depcmds'] = iter(depcmds)
+                frame['nrepls'] = 0
+                frame['indenter'] = TextIndenter(dep.indent)
+                continue
+            text = _out(text, level)
+            if text:
+                yield text
+
 ################################################################################
 
 class EventHandler:
@@ -2192,23 +3476,27 @@ class EventHandler:
 
 ################################################################################
 
-class VfileInfo:
+class VfileInfo(object):
     """Meta information about Vfile
     """
-    ## format (extension, like '.md')
-    fmt = None
-    ## name of file
-    name = None
-    ## mode bits (see os.chmod())
-    mode = None
-    ## access time
-    atime = None
-    ## modified time
-    mtime = None
+    __slots__ = (
+        ## format (extension, like '.md')
+        'fmt',
+        ## name of file
+        'name',
+        ## mode bits (see os.chmod())
+        'mode',
+        ## access time
+        'atime',
+        ## modified time
+        'mtime',
+    )
 
     def __init__(self, **kw):
-        for n,v in kw.items():
-            setattr(self, n, v)
+        for n in VfileInfo.__slots__:
+            setattr(self, n, kw.pop(n, None))
+        if kw:
+            raise TypeError("unexpected VfileInfo attributes: %s"%', '.join(kw))
         self._normalize()
 
     def _normalize(self):
@@ -2264,6 +3552,10 @@ class Vfile:
     True
     >>> rbuf == buf
     True
+
+    Read decoded text (via mmap, CRLF are translated):
+    >>> vf.close().readtext() == 'Hello there!'
+    True
     >>> if vf: del vf
     >>> os.remove(ntmp)
 
@@ -2305,6 +3597,12 @@ class Vfile:
     fileobj = None
     ## True if local FS file is mapped to local FS
     fakemap = False
+    ## size of decoded by readtext() blocks of file with CRLF
+    textblocksize = 1<<20
+    ## fetched bytes are kept in memory (in buffer) instead of tmp file
+    inmemory = False
+    ## fetched bytes if Vfile is mapped to memory
+    buffer = None
 
     def __init__(self, url):
         self.orig_uri = Uri(url)
@@ -2394,6 +3692,10 @@ class Vfile:
             self.info = self.obtaininfo()
             if info:
                 self.info.update(info)
+            if self.inmemory:
+                # bytes are read directly, without tmp file
+                self.buffer = buffer
+                return self
             self.fd, fpath = tempfile.mkstemp(suffix=self.info.fmt, prefix=self.info.name + '.')
             #Vfile._tmpfiles.append((self.fd, fpath))
             if self.info.mode:
@@ -2412,8 +3714,13 @@ class Vfile:
         if self.fd:
             os.close(self.fd)
             self.fd = None
+        self.buffer = None
         return self
 
+    def ismapped(self):
+        """To check that is mapped (to tmp file or to memory)"""
+        return bool(self.fd) or self.buffer is not None
+
     def remove(self):
         """VERY DANGEROUSE: if mapping is local file to local file, this method will
         delete original file!"""
@@ -2430,6 +3737,94 @@ class Vfile:
         """
         raise NotImplementedError
 
+    def readtext(self, encoding='utf8'):
+        """Returns text of mapped file, '\\r\\n' are translated to '\\n'.
+        File is memory-mapped and decoded directly from mapping, so bytes
+        of whole file are not copied in memory. CRLF are translated in bytes
+        (before decoding), so encoding should be ASCII-compatible. Vfile
+        mapped to memory is decoded from self.buffer
+
+        >>> fdtmp,ntmp = tempfile.mkstemp()
+        >>> buf = b'a\\r\\nb' + b'\\xc3\\xa9\\r' + b'\\n\\rc\\r\\n'
+        >>> os.write(fdtmp, buf) == len(buf)
+        True
+        >>> os.close(fdtmp)
+        >>> vf = Vfile.create_vfile(ntmp).map()
+        >>> vf.readtext() == buf.decode('utf8').replace('\\r\\n', '\\n')
+        True
+        >>> vf.textblocksize = 4
+        >>> vf.readtext() == buf.decode('utf8').replace('\\r\\n', '\\n')
+        True
+        >>> del vf
+        >>> os.remove(ntmp)
+
+        Vfile mapped to memory:
+        >>> class MemVfile(Vfile):
+        ...     inmemory = True
+        ...     def fetch(self, parser=None): return (None, buf)
+        >>> vf = MemVfile('http://localhost/a.md').map()
+        >>> vf.fd is None, vf.readtext() == buf.decode('utf8').replace('\\r\\n', '\\n')
+        (True, True)
+        """
+        if not self.ismapped(): raise ValueError('Vfile was not mapped')
+        if self.buffer is not None:
+            buf = self.buffer
+            if b'\r\n' in buf:
+                buf = buf.replace(b'\r\n', b'\n')
+            return codecs.decode(buf, encoding)
+        if os.fstat(self.fd).st_size == 0:
+            return codecs.decode(b'', encoding)
+        mm = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+        try:
+            if mm.find(b'\r\n') == -1:
+                return codecs.decode(mm, encoding)
+            # translate by blocks; block ending with '\r' is extended by one
+            # byte to not split '\r\n'
+            buf = bytearray()
+            beg = 0
+            while beg < len(mm):
+                end = beg + self.textblocksize
+                if mm[end - 1:end] == b'\r':
+                    end += 1
+                buf += mm[beg:end].replace(b'\r\n', b'\n')
+                beg = end
+            return codecs.decode(buf, encoding)
+        finally:
+            mm.close()
+
+    def digest(self, algorithm='sha1'):
+        """Returns hex digest of mapped file content (file is memory-mapped)
+
+        >>> fdtmp,ntmp = tempfile.mkstemp()
+        >>> os.write(fdtmp, b'abc') == 3
+        True
+        >>> os.close(fdtmp)
+        >>> vf = Vfile.create_vfile(ntmp).map()
+        >>> vf.digest() == hashlib.sha1(b'abc').hexdigest()
+        True
+        >>> del vf
+        >>> os.remove(ntmp)
+
+        Vfile mapped to memory:
+        >>> class MemVfile(Vfile):
+        ...     inmemory = True
+        ...     def fetch(self, parser=None): return (None, b'a\\r\\nb')
+        >>> vf = MemVfile('http://localhost/a.md').map()
+        >>> vf.digest() == hashlib.sha1(b'a\\r\\nb').hexdigest()
+        True
+        """
+        if not self.ismapped(): raise ValueError('Vfile was not mapped')
+        h = hashlib.new(algorithm)
+        if self.buffer is not None:
+            h.update(self.buffer)
+        elif os.fstat(self.fd).st_size != 0:
+            mm = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+            try:
+                h.update(mm)
+            finally:
+                mm.close()
+        return h.hexdigest()
+
     def isopen(self):
         """To check that is opened already"""
         return bool(self.fileobj)
@@ -2437,12 +3832,31 @@ class Vfile:
     # lightweight emulation of file:
 
     def open(self, mode='rb', *args):
-        """Opens file - set self.fileobj from self.fd (got early by map())
-        and becames like file-object
+        """Opens file - set self.fileobj from self.fd or self.buffer (got early
+        by map()) and becames like file-object. Bytes are read as is (CRLF
+        are not translated)
+
+        >>> class MemVfile(Vfile):
+        ...     inmemory = True
+        ...     def fetch(self, parser=None): return (None, b'a\\r\\nb')
+        >>> vf = MemVfile('http://localhost/a.md').map()
+        >>> vf.open().read() == b'a\\r\\nb'
+        True
+        >>> _ = vf.seek(3); vf.read() == b'b'
+        True
+        >>> vf.open()
+        Traceback (most recent call last):
+            ...
+        ValueError: Vfile is already opened
+        >>> vf.close().unmap().ismapped()
+        False
         """
-        if not self.fd: raise ValueError('Vfile was not mapped')
+        if not self.ismapped(): raise ValueError('Vfile was not mapped')
         if self.fileobj: raise ValueError('Vfile is already opened')
-        self.fileobj = os.fdopen(os.dup(self.fd), mode, *args)
+        if self.buffer is not None:
+            self.fileobj = io.BytesIO(self.buffer)
+        else:
+            self.fileobj = os.fdopen(os.dup(self.fd), mode, *args)
         return self
 
     def seek(self, *args):
@@ -2634,10 +4048,9 @@ class Uri:
 
 ################################################################################
 
-class Token:
-    text = ''
-    start = -1
-    end = -1
+class Token(object):
+    """Token of parsed document: text and it's position in input"""
+    __slots__ = ('text', 'start', 'end')
 
     def __init__(self, text, start=-1, end=-1):
         self.text = text
@@ -2646,11 +4059,17 @@ class Token:
     def __repr__(self):
         return '<%s at %d...%d: %s>' % (self.__class__.__name__, self.start, self.end, self.text)
 
-class EndToken(Token): pass
+class EndToken(Token):
+    __slots__ = ()
 
-class CmdToken(Token): pass
+class CmdToken(Token):
+    __slots__ = ()
 
 class InlCodeToken(Token):
+    __slots__ = ()
+    ## {nl: compiled re} - cache of linearize()
+    _nlcres = {}
+
     @staticmethod
     def linearize(text, nl=('\n',), space=' '):
         """Convert new-lines symbols|text-fragments (nl) to space
@@ -2664,13 +4083,18 @@ class InlCodeToken(Token):
         >>> InlCodeToken.linearize('aaa\\n\\nbbb')
         'aaa bbb'
         """
-        if isinstance(nl, (list, tuple)):
-            nl = '|'.join('(%s)'%n for n in nl)
-        re_ = '(%s)+'%nl
-        cre_ = re.compile(re_)
+        if isinstance(nl, list):
+            nl = tuple(nl)
+        cre_ = InlCodeToken._nlcres.get(nl)
+        if cre_ is None:
+            re_ = '|'.join('(%s)'%n for n in nl) if isinstance(nl, tuple) else nl
+            cre_ = re.compile('(%s)+'%re_)
+            InlCodeToken._nlcres[nl] = cre_
         return cre_.sub(space, text).strip(space)
 
 class BlkCodeToken(Token):
+    __slots__ = ()
+
     def jointoken(self, token):
         """Join token to existent text"""
         self.text = self.text.rstrip('\n') + '\n' + token.text.lstrip('\n')
@@ -2803,6 +4227,14 @@ class Parser:
     parent = None
     ## catcher of events {event:EventTrap}
     eventtraps = None
+    ## version of vars, changed on each vars updating (used by expand() cache)
+    varsversion = 0
+    ## list of (position, cmd. text, body texts) - chunks definitions in order
+    ## of _parse() (are stored by ParseCache)
+    definitions = None
+    ## IncludeResolver with loaded included files (only of root parser, while
+    ## post-processing)
+    includes = None
 
     ## supported file extensions by concrete parser class
     ext = ()
@@ -2821,6 +4253,8 @@ class Parser:
         self.chunkdict = ChunkDict()
         self.errloc = ErrorLocator()
         self.vars = {ANONDICTNAME:{}}
+        self.varsversion = 0
+        self.definitions = []
         self.handlers = []
         Cmd.syntax.setsurr(self.surr)
         self.outdir = ''
@@ -2977,8 +4411,11 @@ class Parser:
         return lncoords
 
     def readfile(self, file):
-        """Returns content of file"""
-        # FIXME improve
+        """Returns content of file. Mapped Vfile is read with readtext()
+        (via mmap or from memory)
+        """
+        if isinstance(file, Vfile) and file.ismapped():
+            return file.readtext()
         return fix_crlf(file.read().decode('utf8'))
         #if isinstance(file, StringTypes23):
             #return fread23(file)
@@ -3135,35 +4572,158 @@ class Parser:
         """General usage method for processing input file.
         Flag flush enable writing files with <<file.*, FSPATH>> command.
         """
+        return self.loadfile(file).postprocess(flush=flush)
+
+    def loadfile(self, file):
+        """Parse file (path or mapped and opened Vfile) to chunks, without
+        post-processing of commands (see postprocess()). Returns self
+        """
         self._reset()
         if isinstance(file, StringTypes23):
             file = Vfile.create_vfile(file).map(self).open()
-            return self.parsefile(file, flush=flush)
             #file = self._safe_create_vfile(file)
             #if not file: return self
-            #else: return self.parsefile(file, flush=flush)
-        else:
-            # treats as file-object
-            self.infile = file
+        # treats as file-object
+        self.infile = file
 
         # determine self.outdir
         self.setupoutdir(file)
 
-        filetext = self.readfile(file)
-        self.errloc.config(filename=Uri(self.infile).getmoniker(), lncoords=self.findlines(filetext))
-        # parse file content
-        self._parse(filetext)
+        parsecache = self.engine.parsecache if self.engine else None
+        cachekey = parsecache.key(self, file) if parsecache else None
+        definitions = parsecache.load(cachekey) if cachekey else None
+        if definitions is None:
+            filetext = self.readfile(file)
+            # lines coords are needed only on error, so they are found lazy
+            self.errloc.config(filename=Uri(self.infile).getmoniker(),
+                    lnfinder=functools.partial(self.findlines, filetext))
+            # parse file content
+            self._parse(filetext)
+            if cachekey:
+                parsecache.store(cachekey, self.definitions)
+        else:
+            # file is not changed, so definitions of chunks are got from cache
+            self.errloc.config(filename=Uri(self.infile).getmoniker(),
+                    lnfinder=lambda: self.findlines(self.readfile(file)))
+            self._parse(None, definitions=definitions)
         self.chunkdict.check_cycles()
+        return self
+
+    def postprocess(self, flush=True):
+        """Post-process commands of loaded file (see loadfile()). Root parser
+        resolves tree of included files first, if engine has jobs > 1 (see
+        IncludeResolver). Flag flush enable writing of output files
+        """
+        # included files may be loaded with another syntax after this one
+        Cmd.syntax.setsurr(self.surr)
+        if self.parent is None and self.engine and self.engine.jobs > 1:
+            self.includes = IncludeResolver(self.engine.jobs).resolve(self)
         # post-process of commands
         for cmd in self.chunkdict.keys():
             self.emitevent(cmd, 'post', parser=self, flush=flush)
+        self.includes = None
+        if flush:
+            self.tangle_all()
         return self
 
+    def tangle_all(self):
+        """Expand all output files (<<file.*>> commands) in one sweep: shared
+        chunks are expanded once, in dependency order, then files are written.
+        In stream mode of engine text of each file is written by fragments
+        while expanding (see ChunkDict.iterexpand()). In incremental mode of
+        engine files with not changed inputs are skipped (see BuildManifest).
+        Files are replaced atomically, in onlychanged mode of engine files
+        with the same content are not touched (see FileCmd.write()). Writing
+        errors don't stop other files, they are reported in summary and
+        ParserError is raised at the end. Returns list of file commands
+        """
+        # all file commands, even mounted by <<use>> (path is prefixed then)
+        filecls = tuple(Cmd.get_uniform_commands('FileCmd'))
+        alltargets = [cmd for cmd in self.chunkdict.keys() if isinstance(cmd, filecls)]
+        if self.engine and self.engine.incremental:
+            # only files with changed inputs will be tangled
+            manifest = BuildManifest(self.outdir).load()
+            context = BuildManifest.contextdigest(self)
+            digests = {}
+            targets = []
+            for cmd in alltargets:
+                digest = BuildManifest.inputsdigest(self, cmd, context)
+                if manifest.isuptodate(cmd.outfile, digest):
+                    manifest.skipped += 1
+                else:
+                    digests[id(cmd)] = digest
+                    targets.append(cmd)
+        else:
+            manifest = None
+            targets = alltargets
+        # cmd: text or fragments to write
+        outputs = []
+        if self.engine and self.engine.stream:
+            # each file is written while it's text is expanded
+            for cmd in targets:
+                outputs.append((cmd, self.chunkdict.iterexpand(cmd.jpath(), parser=self)))
+        else:
+            istarget = set(id(cmd) for cmd in targets)
+            # expand shared dependencies first, results are memoized by chunkdict
+            for cmd in self.chunkdict.plainorder(targets):
+                if id(cmd) not in istarget:
+                    self.expand(cmd.jpath())
+            texts = []
+            for cmd in targets:
+                jpath = cmd.jpath()
+                if not self.expand(jpath):
+                    raise ParserError("'%s' can not be expanded"%jpath)
+                texts.append(self.chunkdict.getbykey(cmd).tangle)
+            outputs.extend(zip(targets, texts))
+        written = unchanged = 0
+        failed = set() # ids of file commands
+        for cmd, text in outputs:
+            try:
+                if cmd.write(self, text):
+                    written += 1
+                else:
+                    unchanged += 1
+            except (IOError, OSError) as x:
+                prn("can not write '%s': %s"%(cmd.outfile, x), engine=self.engine, file='stderr')
+                failed.add(id(cmd))
+        prn("%d file(s) written, %d unchanged, %d failed"%(written, unchanged,
+            len(failed)), engine=self.engine, file='stdout')
+        if manifest is not None:
+            for cmd in targets:
+                if id(cmd) in failed:
+                    continue
+                manifest.update(cmd.outfile, digests[id(cmd)])
+                manifest.rebuilt += 1
+            # files which are not tangled from document now
+            manifest.prune(cmd.outfile for cmd in alltargets)
+            manifest.save()
+            prn("%d file(s) rebuilt, %d skipped (inputs are not changed)"%(manifest.rebuilt,
+                manifest.skipped), engine=self.engine, file='stdout')
+        if failed:
+            raise ParserError("%d file(s) can not be written"%len(failed))
+        return alltargets
+
     # XXX does not reset parser state like parsefile()
-    def _parse(self, text):
-        """Parse with error info providing"""
+    def _parse(self, text, definitions=None):
+        """Parse with error info providing. If definitions (see
+        self.definitions) are used, they are defined instead of parsing of text
+
+        >>> p = MDParser()
+        >>> p._parse('<<c.a>> `x` <<c.b>> `y` `z`')
+        3
+        >>> p.definitions
+        [(12, 'c.a', ['x']), (-1, 'c.b', ['y', 'z'])]
+        >>> p1 = Parser()
+        >>> p1._parse(None, definitions=p.definitions)
+        3
+        >>> p1.definitions == p.definitions, p1.chunkdict.getbypath('c.b.1')[1].orig
+        (True, 'z')
+        """
         try:
-            return self.__parse(text)
+            if definitions is None:
+                return self.__parse(text)
+            else:
+                return self.__define_all(definitions)
         except Exception as x:
             tb = sys.exc_info()[2]
             errlocation = self.errloc.locate()
@@ -3173,6 +4733,22 @@ class Parser:
                 file,line = errlocation
                 reraise23(x, "[%s, %d] %s"%(file, line+1, str(x)), tb)
 
+    def __define(self, cmdtext, bodytexts):
+        """Define chunk at current error locator position and remember it in
+        self.definitions
+        """
+        self.definitions.append((self.errloc.pos, cmdtext, bodytexts))
+        self.define_chunk(cmdtext, bodytexts)
+
+    # XXX does not check cycles, do it explicitly
+    def __define_all(self, definitions):
+        """Define chunks from definitions got by __parse() early"""
+        self.errloc.reset()
+        for pos, cmdtext, bodytexts in definitions:
+            self.errloc.config(pos=pos)
+            self.__define(cmdtext, bodytexts)
+        return len(self.chunkdict)
+
     # XXX does not check cycles, do it explicitly
     def __parse(self, text):
         """Parse text. Don't forget to check cycles after!
@@ -3216,13 +4792,13 @@ class Parser:
                     state = 'body'
                 elif isinstance(token, CmdToken):
                     if _iscmddef_right(cmdtext, bodytexts):
-                        self.define_chunk(cmdtext, bodytexts) # bodytexts is []
+                        self.__define(cmdtext, bodytexts) # bodytexts is []
                     state = 'start'
                     cmdtext = ''; bodytexts = []
                     continue
                 elif isinstance(token, EndToken):
                     if _iscmddef_right(cmdtext, bodytexts):
-                        self.define_chunk(cmdtext, bodytexts) # bodytexts is []
+                        self.__define(cmdtext, bodytexts) # bodytexts is []
                     break
                 else:
                     raise ParserError('syntax error: expected InlCodeToken or BlkCodeToken')
@@ -3231,13 +4807,13 @@ class Parser:
                     bodytexts.append(token.text)
                 elif isinstance(token, CmdToken):
                     if _iscmddef_right(cmdtext, bodytexts):
-                        self.define_chunk(cmdtext, bodytexts)
+                        self.__define(cmdtext, bodytexts)
                     state = 'start'
                     cmdtext = ''; bodytexts = []
                     continue
                 elif isinstance(token, EndToken):
                     if _iscmddef_right(cmdtext, bodytexts):
-                        self.define_chunk(cmdtext, bodytexts)
+                        self.__define(cmdtext, bodytexts)
                     break
             itok += 1
         #print [c.jpath() for c in list(self.chunkdict.keys())]
@@ -3257,11 +4833,21 @@ class Parser:
         else:
             # no such dict yet
             self.vars[dictname] = varsdict.copy()
+        self._varschanged()
+
+    def _varschanged(self):
+        """Vars were changed, so memoized expansions are invalid"""
+        self.varsversion += 1
+        self.chunkdict.invalidate()
 
     def updatehandlers(self, handlers):
         """Add new event handlers"""
+        nhandlers = len(self.handlers)
         self.handlers.extend(handlers)
         self.handlers = list(set(self.handlers)) # make unique handlers list
+        if len(self.handlers) != nhandlers:
+            # handlers can change expanded text
+            self.chunkdict.invalidate()
 
     def getvar(self, varname, dictname=UNDEFINED, default=UNDEFINED):
         """Get var value from dict (if dictname is used), args no mean,
@@ -3297,6 +4883,7 @@ class Parser:
         for h in handlers:
             h.change_gpath(prefix=path)
         self.handlers.extend(handlers)
+        self.chunkdict.invalidate()
 
     def _mergevars(self, othparser, path=''):
         """Merge vars dictionaries with vars of othparser. They names
@@ -3373,6 +4960,7 @@ class Parser:
                         myvars[varname] = varvalue
             else:
                 self.vars[newdictname] = vars.copy()
+        self._varschanged()
 
     def importparser(self, othparser, path=''):
         """Does importing of one parsed file (result of parsing is in othparser)
@@ -3470,34 +5058,52 @@ class ErrorLocator:
     """
     ## parsed file name
     filename = None
-    ## positions of lines: coords of its line-breaking symbol
+    ## positions of lines: sorted array of coords of its line-breaking symbol
     lncoords = None
+    ## callable returning lines coords (or None), is called on first locate()
+    lnfinder = None
     ## position in text; must be set before locate() call
     pos = None
 
     def __init__(self):
         self.filename = ''
-        self.lncoords = []
+        self.lncoords = array.array('l')
+        self.lnfinder = None
 
-    def config(self, filename=None, lncoords=None, pos=None):
-        """Set current context, lncoords is the list of line coordinates
+    def config(self, filename=None, lncoords=None, pos=None, lnfinder=None):
+        """Set current context, lncoords is the list of line coordinates,
+        lnfinder is callable returning them (to be called only if locate()
+        is needed)
 
         >>> l = ErrorLocator()
         >>> l.config('file', [50, 20, 10, 0, 4])
-        >>> l.lncoords
+        >>> list(l.lncoords)
         [0, 4, 10, 20, 50]
         >>> l.config(pos=10)
         >>> l.pos
         10
+        >>> l.config(lnfinder=lambda: [7, 3])
+        >>> l.lnfinder is None, list(l.getlncoords()), l.lnfinder is None
+        (False, [3, 7], True)
         """
         if filename is not None:
             self.filename = filename
         if lncoords is not None:
-            lncoords.sort()
-            self.lncoords = lncoords
+            self.lncoords = array.array('l', sorted(lncoords))
+            self.lnfinder = None
+        if lnfinder is not None:
+            self.lnfinder = lnfinder
         if pos is not None:
             self.pos = pos
 
+    def getlncoords(self):
+        """Returns lncoords, finds them with lnfinder if it's set"""
+        if self.lnfinder is not None:
+            lncoords = self.lnfinder()
+            self.lnfinder = None
+            self.lncoords = array.array('l', sorted(lncoords or ()))
+        return self.lncoords
+
     def reset(self):
         """Opposite to config(), after call, locate() w/o pos arg returns None"""
         self.pos = None
@@ -3520,7 +5126,7 @@ class ErrorLocator:
         """
         if pos is None: pos = self.pos
 
-        if self.filename and self.lncoords and pos is not None:
+        if self.filename and pos is not None and self.getlncoords():
             return (self.filename, self._findline(pos))
         else:
             return ('<str>', 0) if default else None 
@@ -3549,10 +5155,642 @@ class ErrorLocator:
         >>> l._findline(100)
         5
         """
-        for ln, lncoord in enumerate(self.lncoords):
-            if pos <= lncoord:
-                return ln
-        return ln+1
+        return bisect.bisect_left(self.getlncoords(), pos)
+
+################################################################################
+
+class IncludeResolver:
+    """Resolves tree of included (<<use>>) files of parser before it's
+    post-processing: files are fetched (mapped) by pool of jobs threads, each
+    fetched file is parsed (in calling thread) at once, then it's includes are
+    fetched too. Merging is not changed: UseCmd gets loaded parser by pop() and
+    imports it while post-processing, so in declaration order
+
+    >>> indir = tempfile.mkdtemp()
+    >>> fwrite23(os.path.join(indir, 'a.md'), 'Use <<use, b.md>> and <<c.a>> `a`')
+    >>> fwrite23(os.path.join(indir, 'b.md'), 'Use <<use, c.md>> and <<c.b>> `b`')
+    >>> fwrite23(os.path.join(indir, 'c.md'), 'Chunk <<c.c>> `c`')
+    >>> p = MDParser().loadfile(os.path.join(indir, 'a.md'))
+    >>> ir = IncludeResolver(jobs=2).resolve(p)
+    >>> usecmd = p.chunkdict.get_uniform_commands('UseCmd')[0]
+    >>> pb = ir.pop(usecmd)
+    >>> pb.parent is p, pb.chunkdict.getbypath('c.b')[1].orig == 'b'
+    (True, True)
+    >>> usecmd = pb.chunkdict.get_uniform_commands('UseCmd')[0]
+    >>> ir.pop(usecmd).chunkdict.getbypath('c.c')[1].orig == 'c'
+    True
+    >>> ir.pop(usecmd) is None
+    True
+    >>> for f in os.listdir(indir): os.remove(os.path.join(indir, f))
+    >>> os.rmdir(indir)
+    """
+    ## max. number of fetching threads
+    jobs = 1
+    ## {id(UseCmd): (UseCmd, parser of included file, error)}
+    resolved = None
+
+    def __init__(self, jobs=1):
+        self.jobs = max(1, jobs)
+        self.resolved = {}
+
+    def _submit(self, parser, tasks):
+        """Put tasks of fetching of files included by parser, returns their
+        number. Not resolved includes are skipped, they are reported by UseCmd
+        """
+        ntasks = 0
+        for cmd in parser.chunkdict.get_uniform_commands('UseCmd'):
+            infile = parser.ensureinput(''.join(cmd.body))
+            if not infile:
+                continue
+            try:
+                inclparser = Parser.create_parser(parser.engine, infile,
+                        fmt=cmd.getarg('fmt', ''), parent=parser)
+            except ParserError:
+                continue
+            self.resolved[id(cmd)] = (cmd, inclparser, None)
+            tasks.put((id(cmd), infile, inclparser))
+            ntasks += 1
+        return ntasks
+
+    @staticmethod
+    def _fetch(tasks, results):
+        """Thread of fetching: gets (key, infile, parser) from tasks until
+        None, puts (key, mapped and opened Vfile, error) to results
+        """
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            key, infile, inclparser = task
+            try:
+                results.put((key, Vfile.create_vfile(infile).map(inclparser).open(), None))
+            except Exception as x:
+                results.put((key, None, x))
+
+    def resolve(self, parser):
+        """Fetch and load (see Parser.loadfile()) all files included by
+        parser and by included files. Errors are kept until pop(). Returns self
+        """
+        tasks = queue.Queue()
+        results = queue.Queue()
+        threads = [threading.Thread(target=IncludeResolver._fetch, args=(tasks, results))
+                for _ in range(self.jobs)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            npending = self._submit(parser, tasks)
+            while npending:
+                key, vfile, error = results.get()
+                npending -= 1
+                cmd, inclparser, _ = self.resolved[key]
+                if error is None:
+                    try:
+                        inclparser.loadfile(vfile)
+                        npending += self._submit(inclparser, tasks)
+                    except Exception as x:
+                        error = x
+                self.resolved[key] = (cmd, inclparser, error)
+        finally:
+            for thread in threads:
+                tasks.put(None)
+            for thread in threads:
+                thread.join()
+        return self
+
+    def pop(self, cmd):
+        """Returns loaded parser of file included by UseCmd cmd or None if it
+        was not resolved. Error of fetching or parsing is raised here
+        """
+        _, inclparser, error = self.resolved.pop(id(cmd), (None, None, None))
+        if error is not None:
+            raise error
+        return inclparser
+
+################################################################################
+
+class ParseCache:
+    """On-disk cache of parsed documents: definitions of chunks found by
+    Parser._parse() (see Parser.definitions) are saved in JSON file of cache
+    directory (readable only by owner). Key is hash of document content,
+    parser class and it's config (so changed document or config is parsed
+    again). Parser defines chunks
+    from cache like after parsing, so vars and handlers are created again by
+    'define' events. Total size of cache files is limited by maxsize, least
+    recently used files are removed when total size (counted once, then
+    updated by store()) exceeds it
+
+    >>> cachedir = tempfile.mkdtemp()
+    >>> pc = ParseCache(cachedir, maxsize=1000)
+    >>> p = MDParser()
+    >>> key = pc.key(p, None) # not mapped file is not cached
+    >>> key is None
+    True
+    >>> key = 'k' + 40*'0'
+    >>> pc.load(key) is None
+    True
+    >>> pc.store(key, [(12, 'c.a', ['x'])])
+    >>> pc.load(key) == [(12, 'c.a', ['x'])]
+    True
+    >>> stat.S_IMODE(os.stat(pc._path(key)).st_mode) == 0o600
+    True
+    >>> pc.info()
+    CacheInfo(hits=1, misses=1, size=1, maxsize=1000)
+    >>> for i in range(20): pc.store('k%040d'%i, [(0, 'c.a', [100*'x'])])
+    >>> size = sum(os.path.getsize(os.path.join(cachedir, f)) for f in os.listdir(cachedir))
+    >>> size <= 1000, size == pc._size
+    (True, True)
+
+    File removed by another process while evicting is skipped:
+    >>> files = pc._files()
+    >>> pc._files = lambda: files + [(0, 2000, os.path.join(cachedir, 'gone' + ParseCache.EXT))]
+    >>> pc.evict()
+    >>> del pc._files
+    >>> pc.clear()
+    >>> os.listdir(cachedir)
+    []
+    >>> os.rmdir(cachedir)
+    """
+    ## directory of cache files
+    cachedir = ''
+    ## max. total size of cache files in bytes
+    maxsize = 0
+    ## counters of load() hits/misses
+    hits = 0
+    misses = 0
+
+    ## extension of cache files
+    EXT = '.parsed'
+    ## default cache directory
+    DEFAULTDIR = os.path.join(os.path.expanduser('~'), '.nanolp', 'parsecache')
+
+    def __init__(self, cachedir=None, maxsize=64*1024*1024):
+        self.cachedir = cachedir or ParseCache.DEFAULTDIR
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        # total size of cache files, None if it's not counted yet
+        self._size = None
+
+    def key(self, parser, file):
+        """Returns key of file to be parsed by parser or None if file can not
+        be cached (only mapped Vfile can be)
+        """
+        if not isinstance(file, Vfile) or not file.ismapped():
+            return None
+        parser_class = parser.__class__
+        config = [(name, getattr(parser_class, name)) for name in parser_class.getcfgparams()]
+        commands = sorted(cls.__name__ for cls in Cmd.commands)
+        h = hashlib.sha1()
+        h.update(strtobytes23(repr((__VERSION__, _PY23, parser_class.__name__, config, commands))))
+        return '%s%s'%(file.digest(), h.hexdigest())
+
+    def _path(self, key):
+        return os.path.join(self.cachedir, key + ParseCache.EXT)
+
+    def load(self, key):
+        """Returns definitions or None if there are not in cache"""
+        path = self._path(key)
+        try:
+            with open(path, 'rt') as f:
+                definitions = [(pos, cmdtext, bodytexts) for pos, cmdtext, bodytexts in json.load(f)]
+            # to be the most recently used
+            os.utime(path, None)
+        except Exception:
+            # no such file or file is broken
+            if os.path.exists(path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                self._size = None
+            self.misses += 1
+            return None
+        self.hits += 1
+        return definitions
+
+    def store(self, key, definitions):
+        """Save definitions to cache, remove least recently used files if
+        total size exceeds maxsize
+        """
+        if not os.path.exists(self.cachedir):
+            os.makedirs(self.cachedir, 0o700)
+        path = self._path(key)
+        oldsize = os.path.getsize(path) if os.path.exists(path) else 0
+        tmpfile = '%s.%d.tmp'%(path, os.getpid())
+        try:
+            fd = os.open(tmpfile, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wt') as f:
+                json.dump(definitions, f)
+            size = os.path.getsize(tmpfile)
+            freplace23(tmpfile, path)
+        finally:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+        if self._size is None:
+            self._size = sum(f[1] for f in self._files())
+        else:
+            self._size += size - oldsize
+        if self._size > self.maxsize:
+            self.evict()
+
+    def _files(self):
+        """Returns list of (mtime, size, path) of cache files"""
+        files = []
+        if os.path.exists(self.cachedir):
+            for fname in os.listdir(self.cachedir):
+                if fname.endswith(ParseCache.EXT):
+                    path = os.path.join(self.cachedir, fname)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        # removed by another process
+                        continue
+                    files.append((st.st_mtime, st.st_size, path))
+        return files
+
+    def evict(self):
+        """Remove least recently used files while total size exceeds maxsize"""
+        files = self._files()
+        size = sum(f[1] for f in files)
+        files.sort()
+        for mtime, fsize, path in files:
+            if size <= self.maxsize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # removed by another process
+                pass
+            size -= fsize
+        self._size = size
+
+    def clear(self):
+        """Remove all cache files"""
+        for mtime, fsize, path in self._files():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._size = None
+
+    def info(self):
+        """Returns CacheInfo, size is number of cache files"""
+        return CacheInfo(self.hits, self.misses, len(self._files()), self.maxsize)
+
+################################################################################
+
+class HTTPCache:
+    """On-disk cache of fetched HTTP resources: body and validators (ETag,
+    Last-Modified) of response are saved in JSON file of cache directory (body
+    is base64 encoded), name of file is hash of login and URL, file is
+    readable only by owner. Cached
+    resource is revalidated by conditional GET (see validators()), on 304
+    response body is got from cache. Time of last validation is mtime of file.
+    Resource validated less then maxage seconds ago ('maxage' option of URL
+    section in lpurlrc) is not revalidated. Total size of cache files is
+    limited by maxsize, least recently used (by atime) files are removed.
+    Thread-safe
+
+    >>> cachedir = tempfile.mkdtemp()
+    >>> hc = HTTPCache(cachedir, maxsize=1000)
+    >>> url = 'http://localhost/a.md'
+    >>> hc.load(url) is None
+    True
+    >>> hc.store(url, b'abc', etag='"x1"', lastmodified='Sat, 17 Oct 2026 10:00:00 GMT')
+    >>> path = hc._path(url)
+    >>> stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    True
+    >>> hc.load(url, login='user') is None
+    True
+    >>> with open(path, 'rt') as f: sorted(json.load(f).items()) == [('body', 'YWJj'),
+    ...     ('etag', '"x1"'), ('lastmodified', 'Sat, 17 Oct 2026 10:00:00 GMT'), ('url', url)]
+    True
+    >>> entry = hc.load(url)
+    >>> entry['body'] == b'abc', HTTPCache.isfresh(entry, 60), HTTPCache.isfresh(entry, 0)
+    (True, True, False)
+    >>> sorted(HTTPCache.validators(entry).items())
+    [('If-Modified-Since', 'Sat, 17 Oct 2026 10:00:00 GMT'), ('If-None-Match', '"x1"')]
+
+    Validation (304 response) changes only mtime of file (it's not written):
+    >>> os.utime(path, (1000, 1000))
+    >>> ino = os.stat(path).st_ino
+    >>> HTTPCache.isfresh(hc.load(url), 60)
+    False
+    >>> hc.hit(url, entry, validated=True) == b'abc'
+    True
+    >>> os.stat(path).st_ino == ino, HTTPCache.isfresh(hc.load(url), 60)
+    (True, True)
+    >>> hc.info()
+    CacheInfo(hits=1, misses=1, size=1, maxsize=1000)
+    >>> for i in range(20): hc.store('%s?%d'%(url, i), 100*b'x')
+    >>> size = sum(os.path.getsize(os.path.join(cachedir, f)) for f in os.listdir(cachedir))
+    >>> size <= 1000, size == hc._size
+    (True, True)
+    >>> hc.clear()
+    >>> os.listdir(cachedir)
+    []
+    >>> os.rmdir(cachedir)
+    """
+    ## directory of cache files
+    cachedir = ''
+    ## max. total size of cache files in bytes
+    maxsize = 0
+    ## counters of resources got from cache/downloaded
+    hits = 0
+    misses = 0
+
+    ## extension of cache files
+    EXT = '.http'
+    ## default cache directory
+    DEFAULTDIR = os.path.join(os.path.expanduser('~'), '.nanolp', 'httpcache')
+
+    def __init__(self, cachedir=None, maxsize=64*1024*1024):
+        self.cachedir = cachedir or HTTPCache.DEFAULTDIR
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        # total size of cache files, None if it's not counted yet
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _path(self, url, login=''):
+        # the same URL with different logins can give different resources
+        name = hashlib.sha1(strtobytes23(repr((login, url)))).hexdigest()
+        return os.path.join(self.cachedir, name + HTTPCache.EXT)
+
+    def load(self, url, login=''):
+        """Returns cached entry of url fetched with login: dictionary with keys
+        'url', 'body', 'etag', 'lastmodified', 'validated' (time) or None if
+        it's not cached
+        """
+        path = self._path(url, login)
+        try:
+            with open(path, 'rt') as f:
+                entry = json.load(f)
+            if entry['url'] != url:
+                return None
+            entry['body'] = base64.b64decode(entry['body'])
+            st = os.stat(path)
+            entry['validated'] = st.st_mtime
+            # to be the most recently used (mtime is time of validation)
+            os.utime(path, (time.time(), st.st_mtime))
+        except Exception:
+            # no such file or file is broken
+            return None
+        return entry
+
+    def store(self, url, body, etag=None, lastmodified=None, login=''):
+        """Save downloaded body of url (fetched with login) with it's validators
+        to cache
+        """
+        with self._lock:
+            self.misses += 1
+        if not os.path.exists(self.cachedir):
+            try:
+                os.makedirs(self.cachedir, 0o700)
+            except OSError:
+                # created by another thread
+                if not os.path.isdir(self.cachedir): raise
+        entry = dict(url=url, body=base64.b64encode(body).decode('ascii'), etag=etag,
+                lastmodified=lastmodified)
+        path = self._path(url, login)
+        tmpfile = '%s.%d.%d.tmp'%(path, os.getpid(), threading.current_thread().ident)
+        try:
+            # resources can be protected by login
+            fd = os.open(tmpfile, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wt') as f:
+                json.dump(entry, f)
+            size = os.path.getsize(tmpfile)
+            with self._lock:
+                oldsize = os.path.getsize(path) if os.path.exists(path) else 0
+                freplace23(tmpfile, path)
+                if self._size is None:
+                    self._size = sum(f[1] for f in self._files())
+                else:
+                    self._size += size - oldsize
+                if self._size > self.maxsize:
+                    self.evict()
+        finally:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+
+    def hit(self, url, entry, validated=False, login=''):
+        """Returns body of cached entry of url (fetched with login). If entry
+        was validated now (response was 304), it's fresh again
+        """
+        with self._lock:
+            self.hits += 1
+        if validated:
+            entry['validated'] = time.time()
+            try:
+                os.utime(self._path(url, login), (entry['validated'], entry['validated']))
+            except OSError:
+                # removed by another thread
+                pass
+        return entry['body']
+
+    @staticmethod
+    def isfresh(entry, maxage):
+        """Entry was validated less then maxage seconds ago"""
+        return time.time() - entry['validated'] < maxage
+
+    @staticmethod
+    def validators(entry):
+        """Returns headers of conditional GET of entry"""
+        headers = {}
+        # values are ASCII (in Python 2 JSON gives unicode)
+        if entry.get('etag'):
+            headers['If-None-Match'] = str(entry['etag'])
+        if entry.get('lastmodified'):
+            headers['If-Modified-Since'] = str(entry['lastmodified'])
+        return headers
+
+    def _files(self):
+        """Returns list of (atime, size, path) of cache files"""
+        files = []
+        if os.path.exists(self.cachedir):
+            for fname in os.listdir(self.cachedir):
+                if fname.endswith(HTTPCache.EXT):
+                    path = os.path.join(self.cachedir, fname)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        # removed by another thread
+                        continue
+                    files.append((st.st_atime, st.st_size, path))
+        return files
+
+    def evict(self):
+        """Remove least recently used files while total size exceeds maxsize"""
+        files = self._files()
+        size = sum(f[1] for f in files)
+        files.sort()
+        for atime, fsize, path in files:
+            if size <= self.maxsize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= fsize
+        self._size = size
+
+    def clear(self):
+        """Remove all cache files"""
+        with self._lock:
+            for atime, fsize, path in self._files():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._size = None
+
+    def info(self):
+        """Returns CacheInfo, size is number of cache files"""
+        return CacheInfo(self.hits, self.misses, len(self._files()), self.maxsize)
+
+################
+
+class BuildManifest:
+    """Manifest of output files (of <<file.*>> commands) in output directory:
+    for each file digest of it's inputs (chunks which it's expanded from, vars,
+    commands defining event handlers) and size, mtime of written file. If
+    inputs of output file are not changed and file was not changed after
+    writing, it's not expanded and written again
+
+    >>> outdir = tempfile.mkdtemp()
+    >>> outfile = os.path.join(outdir, 'a.out')
+    >>> m = BuildManifest(outdir).load()
+    >>> m.isuptodate(outfile, 'd1')
+    False
+    >>> fwrite23(outfile, 'text')
+    >>> m.update(outfile, 'd1')
+    >>> m.save()
+    >>> m = BuildManifest(outdir).load()
+    >>> m.isuptodate(outfile, 'd1'), m.isuptodate(outfile, 'd2')
+    (True, False)
+    >>> fwrite23(outfile, 'changed text')
+    >>> m.isuptodate(outfile, 'd1')
+    False
+    >>> os.remove(outfile); os.remove(m.path); os.rmdir(outdir)
+    """
+    ## path of manifest file
+    path = ''
+    ## {output file abs. path: [inputs digest, size, mtime]}
+    entries = None
+    ## counters of tangled files
+    rebuilt = 0
+    skipped = 0
+
+    ## name of manifest file in output directory
+    FILENAME = '.nanolp.manifest'
+
+    def __init__(self, outdir):
+        self.path = os.path.join(outdir, BuildManifest.FILENAME)
+        self.entries = {}
+        self.rebuilt = 0
+        self.skipped = 0
+
+    def load(self):
+        """Load manifest file if exists (broken file is ignored)"""
+        try:
+            with open(self.path, 'rt') as f:
+                entries = json.load(f)
+            if isinstance(entries, dict):
+                self.entries = entries
+        except (IOError, OSError, ValueError):
+            pass
+        return self
+
+    def save(self):
+        """Save manifest file (via temporary file)"""
+        tmpfile = '%s.%d.tmp'%(self.path, os.getpid())
+        try:
+            with open(tmpfile, 'wt') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            freplace23(tmpfile, self.path)
+        finally:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+
+    @staticmethod
+    def contextdigest(parser):
+        """Returns digest of inputs shared by all output files of parser:
+        vars and cmd. defining event handlers
+        """
+        oncls = tuple(Cmd.get_uniform_commands('OnCmd'))
+        handlercmds = []
+        for cmd in parser.chunkdict.keys():
+            if isinstance(cmd, oncls) or any(argname.startswith('do.') for argname, _ in cmd.args):
+                handlercmds.append((cmd.jpath(), cmd.args, cmd.body))
+        vars = sorted((dictname, sorted(d.items())) for dictname, d in parser.vars.items())
+        h = hashlib.sha1()
+        h.update(strtobytes23(repr((__VERSION__, _PY23, vars, handlercmds))))
+        return h.hexdigest()
+
+    @staticmethod
+    def inputsdigest(parser, cmd, context=''):
+        """Returns digest of inputs of output file cmd: texts of all chunks
+        reachable from cmd (with texts of included documents) and context
+        (see contextdigest())
+
+        >>> p = Parser()
+        >>> p.define_chunk('file.a', ['<<=c.*>>'])
+        >>> p.define_chunk('c.x', ['x'])
+        >>> p.define_chunk('d', ['d'])
+        >>> cmd = p.chunkdict.getbypath('file.a')[0]
+        >>> d1 = BuildManifest.inputsdigest(p, cmd)
+        >>> p.define_chunk('d', ['d1'])
+        >>> d1 == BuildManifest.inputsdigest(p, cmd)
+        True
+        >>> p.define_chunk('c.y', ['y'])
+        >>> d1 == BuildManifest.inputsdigest(p, cmd)
+        False
+        """
+        chunkdict = parser.chunkdict
+        h = hashlib.sha1()
+        h.update(strtobytes23(repr((context, cmd.outfile if hasattr(cmd, 'outfile') else ''))))
+        visited = set()
+        work = [cmd]
+        while work:
+            cmd = work.pop()
+            if id(cmd) in visited:
+                continue
+            visited.add(id(cmd))
+            chunk = chunkdict.getbykey(cmd)
+            h.update(strtobytes23(repr((cmd.jpath(), cmd.args, cmd.body, chunk.orig))))
+            for dep in reversed(chunk.deps):
+                work.extend(reversed(chunkdict.globpath(dep.jpath())))
+        return h.hexdigest()
+
+    def isuptodate(self, outfile, digest):
+        """Output file was written from inputs with digest and is not changed"""
+        entry = self.entries.get(outfile)
+        if not entry or entry[0] != digest or not os.path.exists(outfile):
+            return False
+        st = os.stat(outfile)
+        return [st.st_size, st.st_mtime] == entry[1:]
+
+    def update(self, outfile, digest):
+        """Output file is written from inputs with digest"""
+        st = os.stat(outfile)
+        self.entries[outfile] = [digest, st.st_size, st.st_mtime]
+
+    def prune(self, outfiles):
+        """Remove entries of files which are not in outfiles (not output
+        files of document now)
+
+        >>> m = BuildManifest('')
+        >>> m.entries = {'a.out': ['d1', 1, 1.0], 'b.out': ['d2', 1, 1.0]}
+        >>> m.prune(['b.out', 'c.out'])
+        >>> sorted(m.entries)
+        ['b.out']
+        """
+        outfiles = set(outfiles)
+        for outfile in list(self.entries):
+            if outfile not in outfiles:
+                del self.entries[outfile]
 
 ################################################################################
 
@@ -3566,12 +5804,40 @@ class Lp:
     quiet = False
     ## output directory (cmdline option, if not used then is '')
     outdir = ''
-
-    def __init__(self, cfgfile='lprc', urlcfgfile='lpurlrc', quiet=False, outdir=''):
+    ## stream output files text (see Parser.tangle_all())
+    stream = False
+    ## ParseCache of parsed documents or None
+    parsecache = None
+    ## don't tangle output files with not changed inputs (see BuildManifest)
+    incremental = False
+    ## don't replace output files with the same content (see FileCmd.write())
+    onlychanged = False
+    ## number of threads fetching included files (see IncludeResolver)
+    jobs = 1
+    ## HTTPCache of fetched HTTP resources or None
+    httpcache = None
+    ## serve stale resources from HTTPCache if server is unreachable
+    offline = False
+    ## {name: pool} of connections/sessions of fetchers, they are shared while
+    ## engine lives (see getpool(), close())
+    pools = None
+
+    def __init__(self, cfgfile='lprc', urlcfgfile='lpurlrc', quiet=False, outdir='',
+            stream=False, parsecache=None, incremental=False, onlychanged=False,
+            jobs=1, httpcache=None, offline=False):
         self.cfgfile = Cfgfile()
         self.urlcfgfile = Urlcfgfile()
         self.quiet = quiet
         self.outdir = outdir
+        self.stream = stream
+        self.parsecache = parsecache
+        self.incremental = incremental
+        self.onlychanged = onlychanged
+        self.jobs = jobs
+        self.httpcache = httpcache
+        self.offline = offline
+        self.pools = OrderedDict()
+        self._poolslock = threading.Lock()
         # load configuration from cfgfile (abs. path or in current dir)
         cfgfile = os.path.abspath(cfgfile)
         self.cfgfile.load(cfgfile) # config file name
@@ -3584,3 +5850,25 @@ class Lp:
         # load URL configuration from urlcfgfile (abs. path or in current dir)
         urlcfgfile = os.path.abspath(urlcfgfile)
         self.urlcfgfile.load(urlcfgfile) # config file name
+
+    def getpool(self, name, factory):
+        """Returns pool of fetchers connections/sessions with name, it's
+        created by factory() on first call. Pool should have close() and
+        summary() (line of summary or '') methods
+        """
+        with self._poolslock:
+            pool = self.pools.get(name)
+            if pool is None:
+                pool = self.pools[name] = factory()
+            return pool
+
+    def close(self):
+        """Print summary of fetchers pools and close them"""
+        with self._poolslock:
+            pools = list(self.pools.values())
+            self.pools.clear()
+        for pool in pools:
+            summary = pool.summary()
+            if summary:
+                prn(summary, engine=self, file='stdout')
+            pool.close()
@@ -7,8 +7,12 @@ import re
 import os
 import io
 import sys
+import time
 import base64
+import socket
+import threading
 import zipfile
+import ftplib
 import subprocess
 from ftplib import FTP
 import nanolp.core as core
@@ -36,22 +40,313 @@ core.Vfile.register(FSURLfile)
 
 ################################################################################
 
+class ConnectionPool:
+    """Persistent connections (sessions) shared by fetches: idle connections
+    are kept per key (server) and are reused by next fetches from the same
+    server. Thread-safe. Successors define how to check and close connection
+
+    >>> class Conn:
+    ...     closed = False
+    ...     def close(self): self.closed = True
+    >>> pool = ConnectionPool(maxconns=1, idletimeout=60)
+    >>> c1, reused = pool.acquire('srv', Conn)
+    >>> reused
+    False
+    >>> pool.release('srv', c1, True)
+    >>> pool.acquire('srv', Conn) == (c1, True)
+    True
+
+    While maxconns connections are busy, acquire() waits for release():
+    >>> got = []
+    >>> t = threading.Thread(target=lambda: got.append(pool.acquire('srv', Conn)))
+    >>> t.start(); time.sleep(0.2)
+    >>> got
+    []
+    >>> pool.release('srv', c1, True)
+    >>> t.join()
+    >>> got == [(c1, True)]
+    True
+    >>> pool.release('srv', c1, True)
+
+    Expired idle connection is closed, new one is created:
+    >>> pool.idletimeout = 0
+    >>> c2, reused = pool.acquire('srv', Conn)
+    >>> c2 is c1, reused, c1.closed
+    (False, False, True)
+    >>> pool.release('srv', c2, False)
+    >>> c2.closed
+    True
+
+    Failed connect() releases busy connection:
+    >>> def connect(): raise ValueError('refused')
+    >>> pool.acquire('srv', connect)
+    Traceback (most recent call last):
+        ...
+    ValueError: refused
+    >>> pool._busy['srv']
+    0
+    >>> pool.acquire('srv', Conn)[1]
+    False
+    """
+    ## name of connections in summary
+    name = 'Connections'
+    ## max. number of connections per key
+    maxconns = 4
+    ## idle connection is closed after this time (in seconds)
+    idletimeout = 15
+    ## counters of fetches via new and reused connections
+    opened = 0
+    reused = 0
+
+    def __init__(self, maxconns=None, idletimeout=None):
+        if maxconns is not None: self.maxconns = maxconns
+        if idletimeout is not None: self.idletimeout = idletimeout
+        self.opened = 0
+        self.reused = 0
+        # {key: [(connection, time of releasing)]}
+        self._idle = {}
+        # {key: number of acquired connections}
+        self._busy = {}
+        self._cond = threading.Condition()
+
+    def isalive(self, conn):
+        """Check of idle connection before reusing"""
+        return True
+
+    def disconnect(self, conn):
+        """Close connection"""
+        conn.close()
+
+    def acquire(self, key, connect, fresh=False):
+        """Returns pair (connection, reused flag) to key. Waits while maxconns
+        connections of key are busy. Most recently used alive idle connection
+        is reused, expired ones are closed. New connection is created by
+        connect(), if fresh - anyway
+        """
+        while True:
+            conn = None
+            expired = []
+            with self._cond:
+                while True:
+                    idle = self._idle.get(key, [])
+                    now = time.time()
+                    while idle and conn is None:
+                        c, released = idle.pop()
+                        if not fresh and now - released < self.idletimeout:
+                            conn = c
+                        else:
+                            expired.append(c)
+                    if conn is not None or self._busy.get(key, 0) < self.maxconns:
+                        break
+                    self._cond.wait()
+                self._busy[key] = self._busy.get(key, 0) + 1
+            for c in expired:
+                self.disconnect(c)
+            if conn is None:
+                try:
+                    return (connect(), False)
+                except:
+                    self.release(key, None, False)
+                    raise
+            if self.isalive(conn):
+                return (conn, True)
+            self.release(key, conn, False)
+
+    def release(self, key, conn, reusable):
+        """Return connection conn acquired for key to idle ones, if it's
+        reusable, otherwise it's closed
+        """
+        with self._cond:
+            self._busy[key] -= 1
+            if reusable:
+                self._idle.setdefault(key, []).append((conn, time.time()))
+            self._cond.notify()
+        if conn is not None and not reusable:
+            self.disconnect(conn)
+
+    def count(self, reused):
+        """Count successful fetch via new or reused connection"""
+        with self._cond:
+            if reused: self.reused += 1
+            else: self.opened += 1
+
+    def close(self):
+        """Close all idle connections"""
+        with self._cond:
+            conns = [conn for idle in self._idle.values() for conn, _ in idle]
+            self._idle.clear()
+        for conn in conns:
+            self.disconnect(conn)
+
+    def summary(self):
+        if not self.opened:
+            return ''
+        return '%s: %d opened, %d reused'%(self.name, self.opened, self.reused)
+
+################################################################################
+
+class HTTPConnectionPool(ConnectionPool):
+    """Persistent (keep-alive) HTTP connections per (scheme, host, port)"""
+    name = 'HTTP connections'
+    ## socket timeout of connections (None - default)
+    timeout = None
+
+    def __init__(self, maxconns=None, idletimeout=None, timeout=None):
+        ConnectionPool.__init__(self, maxconns, idletimeout)
+        self.timeout = timeout
+        self._auths = {}
+
+    def _connect(self, key):
+        scheme, host, port = key
+        conncls = core.httpclient.HTTPSConnection if scheme == 'https' else core.httpclient.HTTPConnection
+        kwargs = {} if self.timeout is None else dict(timeout=self.timeout)
+        return conncls(host, port, **kwargs)
+
+    def request(self, key, target, headers):
+        """GET target (path with query) from server key=(scheme, host, port),
+        returns pair (response, body). If reused connection was closed by
+        server, request is repeated once with new connection
+
+        >>> class Response:
+        ...     status = 200
+        ...     will_close = False
+        ...     def read(self): return b'body'
+        >>> class Conn:
+        ...     closed = dead = False
+        ...     def request(self, method, target, headers): pass
+        ...     def getresponse(self):
+        ...         if self.dead: raise httpclient.BadStatusLine('')
+        ...         return Response()
+        ...     def close(self): self.closed = True
+        >>> pool = HTTPConnectionPool()
+        >>> pool._connect = lambda key: Conn()
+        >>> key = ('http', 'localhost', 80)
+        >>> response, body = pool.request(key, '/a', {})
+        >>> response.status, body == b'body'
+        (200, True)
+        >>> c1 = pool._idle[key][-1][0]
+        >>> c1.dead = True # closed by server while it was idle
+        >>> pool.request(key, '/b', {})[1] == b'body'
+        True
+        >>> c1.closed, pool._idle[key][-1][0] is c1
+        (True, False)
+        >>> pool.summary()
+        'HTTP connections: 2 opened, 0 reused'
+        """
+        for attempt in (0, 1):
+            conn, reused = self.acquire(key, lambda: self._connect(key), fresh=attempt > 0)
+            reusable = False
+            try:
+                conn.request('GET', target, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+                reusable = not response.will_close
+                self.count(reused)
+                return (response, body)
+            except (core.httpclient.HTTPException, socket.error):
+                if not reused or attempt:
+                    raise
+            finally:
+                self.release(key, conn, reusable)
+
+    def basicauth(self, login, password):
+        """Value of Authorization header for login, password (encoded once)"""
+        auth = self._auths.get((login, password))
+        if auth is None:
+            auth = '%s:%s'%(login, password)
+            try:
+                auth = base64.standard_b64encode(auth)
+            except TypeError:
+                auth = base64.standard_b64encode(auth.encode()).decode()
+            auth = self._auths[(login, password)] = 'Basic %s'%auth
+        return auth
+
+################################################################################
+
+class HTTPStatusError(IOError):
+    """Error status of HTTP response (server is reachable)"""
+
 class HTTPfile(core.Vfile):
-    """HTTP fetcher for 'http://...'
+    """HTTP fetcher for 'http://...'. Connections are kept in
+    HTTPConnectionPool of engine, so files from one server are fetched via
+    the same connection. If proxy is used, fetching is via urlopen(). If
+    engine has HTTPCache, cached files are revalidated by conditional GET,
+    in offline mode they are used when server is unreachable
     """
     descr = 'http://<url><:port?>/<path>'
     scheme = 'http://'
+    ## max. number of followed redirections
+    maxredirects = 5
 
     def fetch(self, parser=None):
+        engine = parser.engine if parser else None
+        # first get login, password
+        if engine:
+            urlopts = engine.urlcfgfile.urlopts(self.orig_uri.url) or {}
+        else:
+            urlopts = {}
+        login = urlopts.get('login', '') #.encode('utf8')
+        password = urlopts.get('password', '') #.encode('utf8')
+        url = self.orig_uri.url
+        cache = engine.httpcache if engine else None
+        entry = cache.load(url, login=login) if cache else None
+        if entry and core.HTTPCache.isfresh(entry, float(urlopts.get('maxage') or 0)):
+            return (None, cache.hit(url, entry, login=login))
+        validators = core.HTTPCache.validators(entry) if entry else {}
+        try:
+            status, headers, buffer = self._get(engine, login, password, validators)
+        except HTTPStatusError:
+            raise
+        except (IOError, OSError, core.httpclient.HTTPException) as x:
+            if not (entry and engine.offline):
+                raise
+            core.prn("'%s' is unreachable (%s), cached file is used"%(url, x), engine=engine, file='stdout')
+            return (None, cache.hit(url, entry, login=login))
+        if status == 304 and entry:
+            # not modified
+            return (None, cache.hit(url, entry, validated=True, login=login))
+        if cache:
+            cache.store(url, buffer, etag=headers.get('etag'),
+                    lastmodified=headers.get('last-modified'), login=login)
+        return (None, buffer)
+
+    def _get(self, engine, login, password, headers):
+        """GET of self.orig_uri.url (following redirections) with additional
+        headers, returns (status, {lower-case header name: value}, body).
+        Raises HTTPStatusError on error status
+        """
+        url = self.orig_uri.url
+        parts = core.urlsplit(url)
+        if parts.scheme.lower() in core.getproxies() and not core.proxy_bypass(parts.hostname):
+            return self._urlopen(login, password, headers)
+        if engine:
+            pool = engine.getpool('http', HTTPConnectionPool)
+        else:
+            pool = HTTPConnectionPool()
+        try:
+            headers = dict(headers, Authorization=pool.basicauth(login, password))
+            for _ in range(self.maxredirects + 1):
+                parts = core.urlsplit(url)
+                scheme = parts.scheme.lower()
+                key = (scheme, parts.hostname, parts.port or (443 if scheme == 'https' else 80))
+                target = core.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+                response, buffer = pool.request(key, target, headers)
+                location = response.getheader('location')
+                if response.status in (301, 302, 303, 307, 308) and location:
+                    url = core.urljoin(url, location)
+                    continue
+                if response.status >= 400:
+                    raise HTTPStatusError("HTTP Error %d: %s"%(response.status, response.reason))
+                return (response.status, dict((k.lower(), v) for k, v in response.getheaders()), buffer)
+            raise HTTPStatusError("HTTP Error: too many redirections of '%s'"%self.orig_uri.url)
+        finally:
+            if not engine:
+                pool.close()
+
+    def _urlopen(self, login, password, headers):
+        """Fetch with urlopen() (proxies are supported), returns like _get()"""
         file = None; buffer = None
         try:
-            # first get login, password
-            if parser and parser.engine:
-                urlopts = parser.engine.urlcfgfile.urlopts(self.orig_uri.url) or {}
-            else:
-                urlopts = {}
-            login = urlopts.get('login', '') #.encode('utf8')
-            password = urlopts.get('password', '') #.encode('utf8')
             # Create request instance
             request = core.UrlRequest(self.orig_uri.url)
             auth = '%s:%s'%(login, password)
@@ -60,19 +355,137 @@ class HTTPfile(core.Vfile):
             except TypeError:
                 auth = base64.standard_b64encode(auth.encode()).decode()
             request.add_header("Authorization", "Basic %s"%auth)   
-            file = core.urlopen(request)
+            for name, value in headers.items():
+                request.add_header(name, value)
+            try:
+                file = core.urlopen(request)
+            except core.HTTPError as x:
+                if x.code == 304:
+                    return (304, dict((k.lower(), v) for k, v in x.info().items()), b'')
+                raise HTTPStatusError("HTTP Error %d: %s"%(x.code, x.msg))
             buffer = file.read()
+            status = file.getcode() or 200
+            headers = dict((k.lower(), v) for k, v in file.info().items())
         finally:
             if file:
                 try: file.close()
                 except: pass
-        return (None, buffer)
+        return (status, headers, buffer)
 core.Vfile.register(HTTPfile)
 
 ################################################################################
 
+class FTPSessionPool(ConnectionPool):
+    """Logged in FTP sessions per (host, port, login). Idle session is checked
+    by NOOP before reusing
+    """
+    name = 'FTP sessions'
+    idletimeout = 60
+    ## socket timeout of sessions (None - default)
+    timeout = None
+
+    def __init__(self, maxconns=None, idletimeout=None, timeout=None):
+        ConnectionPool.__init__(self, maxconns, idletimeout)
+        self.timeout = timeout
+
+    def isalive(self, conn):
+        try:
+            conn.voidcmd('NOOP')
+            return True
+        except ftplib.all_errors:
+            return False
+
+    def disconnect(self, conn):
+        try:
+            conn.quit()
+        except ftplib.all_errors:
+            conn.close()
+
+    def _connect(self, host, port, login, password):
+        ftp = FTP()
+        kwargs = {} if self.timeout is None else dict(timeout=self.timeout)
+        try:
+            ftp.connect(host, port, **kwargs)
+            ftp.login(login, password)
+        except:
+            ftp.close()
+            raise
+        return ftp
+
+    def retrieve(self, host, port, login, password, path):
+        """Returns content of file path on FTP server. If reused session was
+        closed by server, retrieving is repeated once with new session
+
+        >>> class Session:
+        ...     closed = broken = False
+        ...     def voidcmd(self, cmd):
+        ...         if self.closed: raise EOFError()
+        ...     def retrbinary(self, cmd, callback):
+        ...         if self.closed or self.broken: raise EOFError()
+        ...         if cmd == 'RETR missing': raise ftplib.error_perm('550 No such file')
+        ...         callback(b'data')
+        ...     def quit(self): self.closed = True
+        ...     close = quit
+        >>> sessions = []
+        >>> pool = FTPSessionPool()
+        >>> pool._connect = lambda host, port, login, password: sessions.append(Session()) or sessions[-1]
+        >>> pool.retrieve('localhost', 21, '', '', 'a') == b'data'
+        True
+
+        Session closed by server is found by NOOP, new one is used:
+        >>> sessions[0].closed = True
+        >>> pool.retrieve('localhost', 21, '', '', 'a') == b'data', len(sessions)
+        (True, 2)
+
+        Answer of server (error_perm) does not close session:
+        >>> pool.retrieve('localhost', 21, '', '', 'missing')
+        Traceback (most recent call last):
+            ...
+        error_perm: 550 No such file
+        >>> pool.retrieve('localhost', 21, '', '', 'a') == b'data', len(sessions)
+        (True, 2)
+
+        Failed retrieving via reused session is repeated once via new one:
+        >>> sessions[1].broken = True
+        >>> pool.retrieve('localhost', 21, '', '', 'a') == b'data', len(sessions), sessions[1].closed
+        (True, 3, True)
+        >>> sessions[2].broken = True
+        >>> Session.broken = True # new sessions too
+        >>> pool.retrieve('localhost', 21, '', '', 'a')
+        Traceback (most recent call last):
+            ...
+        EOFError
+        >>> len(sessions), pool.summary()
+        (4, 'FTP sessions: 3 opened, 1 reused')
+        """
+        key = (host, port, login)
+        for attempt in (0, 1):
+            ftp, reused = self.acquire(key, lambda: self._connect(host, port, login, password),
+                    fresh=attempt > 0)
+            reusable = False
+            buffer_io = io.BytesIO()
+            try:
+                ftp.retrbinary('RETR %s'%path, buffer_io.write)
+                reusable = True
+                self.count(reused)
+                return buffer_io.getvalue()
+            except ftplib.error_perm:
+                # server has answered (no such file, etc), session is alive
+                reusable = True
+                raise
+            except ftplib.all_errors:
+                if not reused or attempt:
+                    raise
+            finally:
+                buffer_io.close()
+                self.release(key, ftp, reusable)
+
+################################################################################
+
 class FTPfile(core.Vfile):
-    """FTP fetcher for 'ftp://...'
+    """FTP fetcher for 'ftp://...'. Logged in sessions are kept in
+    FTPSessionPool of engine, so files from one server are fetched via the
+    same session
     """
     descr = 'ftp://<url><:port?>/<path>'
     scheme = 'ftp://'
@@ -91,22 +504,16 @@ class FTPfile(core.Vfile):
             urlopts = {}
         login = urlopts.get('login', '') #.encode('utf8')
         password = urlopts.get('password', '') #.encode('utf8')
-        ftp = None; buffer_io = None; buffer = None
+        port = int(port)
+        if parser and parser.engine:
+            pool = parser.engine.getpool('ftp', FTPSessionPool)
+        else:
+            pool = FTPSessionPool()
         try:
-            port = int(port)
-            ftp = FTP()
-            ftp.connect(host, port)
-            ftp.login(login, password)
-            buffer_io = io.BytesIO()
-            ftp.retrbinary('RETR %s'%path, buffer_io.write)
-            buffer = buffer_io.getvalue()
+            buffer = pool.retrieve(host, port, login, password, path)
         finally:
-            if ftp:
-                try: ftp.quit()
-                except: pass
-            if buffer_io:
-                try: buffer_io.close()
-                except: pass
+            if not (parser and parser.engine):
+                pool.close()
         return (None, buffer)
 core.Vfile.register(FTPfile)
 
@@ -151,11 +558,78 @@ core.Vfile.register(SHELLfile)
 
 ################################################################################
 
+class ZipArchivePool:
+    """Open ZIP archives (their central directory is read once) shared by
+    ZIPfile fetches, least recently used archives are closed. Key of archive
+    is it's path, mtime and size, so changed archive is opened again.
+    Thread-safe
+
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> zipfname = os.path.join(tmpdir, 'a.zip')
+    >>> def mkzip(text, mtime):
+    ...     with zipfile.ZipFile(zipfname, 'w') as z: z.writestr('a.md', text)
+    ...     os.utime(zipfname, (mtime, mtime))
+    >>> mkzip('v1', 1000)
+    >>> pool = ZipArchivePool(maxsize=1)
+    >>> pool.read(zipfname, 'a.md')[1] == b'v1'
+    True
+    >>> pool.read(zipfname, 'a.md')[1] == b'v1', pool.summary()
+    (True, 'ZIP archives: 1 opened, 1 reused')
+    >>> zip1 = pool._archives.values()[0]
+
+    Changed archive has new key, so it's opened again (and least recently
+    used archive is closed):
+    >>> mkzip('version 2', 2000)
+    >>> pool.read(zipfname, 'a.md')[1] == b'version 2', pool.summary()
+    (True, 'ZIP archives: 2 opened, 1 reused')
+    >>> (os.path.abspath(zipfname), 2000, os.path.getsize(zipfname)) in pool._archives
+    True
+    >>> len(pool._archives), zip1.fp is None
+    (1, True)
+    >>> pool.close()
+    >>> os.remove(zipfname); os.rmdir(tmpdir)
+    """
+    ## max. number of open archives
+    maxsize = 16
+
+    def __init__(self, maxsize=None):
+        if maxsize is not None: self.maxsize = maxsize
+        self._archives = core.LRUCache(self.maxsize, onevict=lambda key, zip: zip.close())
+        self._lock = threading.Lock()
+
+    def read(self, zipfname, fname, password=None):
+        """Returns pair (ZipInfo, bytes) of member fname of archive zipfname"""
+        st = os.stat(zipfname)
+        key = (os.path.abspath(zipfname), st.st_mtime, st.st_size)
+        with self._lock:
+            zip = self._archives.get(key)
+            if zip is None:
+                zip = self._archives[key] = zipfile.ZipFile(zipfname, 'r')
+            fileinfo = zip.getinfo(fname)
+            return (fileinfo, zip.read(fname, password))
+
+    def close(self):
+        """Close all archives"""
+        with self._lock:
+            for zip in self._archives.values():
+                zip.close()
+            self._archives.clear()
+
+    def summary(self):
+        info = self._archives.info()
+        if not info.misses:
+            return ''
+        return 'ZIP archives: %d opened, %d reused'%(info.misses, info.hits)
+
+################################################################################
+
 class ZIPfile(core.Vfile):
-    """ZIP fetcher for 'zip://...'
+    """ZIP fetcher for 'zip://...'. Archives are kept open in ZipArchivePool
+    of engine, member is read to memory (without tmp file)
     """
     descr = 'zip:<path-to-zip>#<path-in-zip>'
     scheme = 'zip:'
+    inmemory = True
 
     def fetch(self, parser=None):
         p = core.url2path(self.orig_uri.url, fragments=True)
@@ -172,10 +646,16 @@ class ZIPfile(core.Vfile):
         # password is string, convert to bytes, but if is empty, set to None (not used)
         password = urlopts.get('password', '').encode('utf8')
         if not password: password = None
-        # opening zip file and read what is need
-        with zipfile.ZipFile(zipfname, 'r') as zip:
-            fileinfo = zip.getinfo(fname)
-            buffer = zip.read(fname, password)
+        # read what is need from opened zip file
+        if parser and parser.engine:
+            pool = parser.engine.getpool('zip', ZipArchivePool)
+        else:
+            pool = ZipArchivePool()
+        try:
+            fileinfo, buffer = pool.read(zipfname, fname, password)
+        finally:
+            if not (parser and parser.engine):
+                pool.close()
         # prepare file metainfo
         name = os.path.basename(fname)
         ext = os.path.splitext(name)[1]
@@ -3,14 +3,19 @@
 # Author: Balkansoft.BlogSpot.com
 # GNU GPL licensed
 
-from urllib2 import urlopen, Request as UrlRequest
-from urlparse import urlparse, urlsplit, urlunsplit
-from urllib import quote as urlquote, unquote as urlunquote
+from urllib2 import urlopen, Request as UrlRequest, HTTPError
+from urlparse import urlparse, urlsplit, urlunsplit, urljoin
+from urllib import quote as urlquote, unquote as urlunquote, getproxies, proxy_bypass
+import httplib as httpclient
 import ConfigParser as configparser
 from SimpleHTTPServer import SimpleHTTPRequestHandler
 from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
 from HTMLParser import HTMLParser
 import __builtin__ as builtins
+import os
+import cPickle as pickle
+import Queue as queue
 
 StringTypes23 = (str, unicode)
 
@@ -23,6 +28,17 @@ def fwrite23(filename, text, mode='wt'):
     with open(filename, mode) as f:
         f.write(text.encode('utf8', errors='replace'))
 
+def fwritelines23(filename, fragments, mode='wt'):
+    with open(filename, mode) as f:
+        for text in fragments:
+            f.write(text.encode('utf8', errors='replace'))
+
+def freplace23(src, dst):
+    if os.name == 'nt' and os.path.exists(dst):
+        # rename() does not replace existing file on Windows
+        os.remove(dst)
+    os.rename(src, dst)
+
 def bytestostr23(b):
     return str(b)
 
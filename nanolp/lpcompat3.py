@@ -3,12 +3,18 @@
 # Author: Balkansoft.BlogSpot.com
 # GNU GPL licensed
 
-from urllib.request import urlopen, Request as UrlRequest
-from urllib.parse import urlparse, urlsplit, urlunsplit, quote as urlquote, unquote as urlunquote
+from urllib.request import urlopen, Request as UrlRequest, getproxies, proxy_bypass
+from urllib.error import HTTPError
+from urllib.parse import urlparse, urlsplit, urlunsplit, urljoin, quote as urlquote, unquote as urlunquote
+import http.client as httpclient
 import configparser
 from http.server import HTTPServer, SimpleHTTPRequestHandler
+from socketserver import ThreadingMixIn
 from html.parser import HTMLParser
 import builtins
+import os
+import pickle
+import queue
 
 StringTypes23 = str
 
@@ -20,6 +26,14 @@ def fwrite23(filename, text, mode='wt'):
     with open(filename, mode, encoding='utf8', errors='replace') as f:
         f.write(text)
 
+def fwritelines23(filename, fragments, mode='wt'):
+    with open(filename, mode, encoding='utf8', errors='replace') as f:
+        for text in fragments:
+            f.write(text)
+
+def freplace23(src, dst):
+    os.replace(src, dst)
+
 def bytestostr23(b):
     return str(b, encoding='utf8')
 
@@ -5,11 +5,89 @@
 
 import re
 import zipfile
-import itertools
 import xml.sax as sax
 import xml.sax.saxutils as saxutils
 import nanolp.core as core
 
+class TextScanner:
+    """One-pass tokenizer of text formats. Rules are pairs (regex, handler):
+    all regexes are combined into one alternation, so text is scanned once and
+    tokens are got in document order (they don't need sorting). Each regex
+    should have at least one group: matched rule is found by index of last
+    matched group. Handler is called as handler(m, i), where i is offset of
+    rule's groups in match m (so N-th group of rule is m.group(i + N)), and
+    returns Token or None to skip the match. Named groups should be unique in
+    all rules, numbered back-references are not allowed. Rules of text formats
+    use cmdrule() for cmd. definitions
+
+    >>> blk = lambda m, i: core.BlkCodeToken(m.group(i + 1), m.start(0), m.end(0))
+    >>> inl = lambda m, i: core.InlCodeToken(m.group(i + 1), m.start(0), m.end(0))
+    >>> rules = (TextScanner.cmdrule(), (r'`([^`]+)`', inl), (r'\[(.*?)\]', blk))
+    >>> toks = TextScanner.tokens(rules, 'a <<c.f>> `x` [y `z`] <<c.g>> `u`')
+    >>> [(tok.__class__.__name__, tok.text) for tok in toks]
+    [('CmdToken', 'c.f'), ('InlCodeToken', 'x'), ('BlkCodeToken', 'y `z`'), ('CmdToken', 'c.g'), ('InlCodeToken', 'u'), ('EndToken', None)]
+    >>> [(tok.start, tok.end) for tok in toks[:3]]
+    [(2, 9), (10, 13), (14, 21)]
+    """
+    ## {(rules, flags): (compiled re, [(handler, groups offset)] for each group index)}
+    _cache = core.LRUCache(64)
+
+    @staticmethod
+    def _cmdtoken(m, i):
+        return core.CmdToken(m.group(i + 1), m.start(0), m.end(0))
+
+    @staticmethod
+    def _inltoken(m, i):
+        return core.InlCodeToken(core.InlCodeToken.linearize(m.group(i + 1)), m.start(0), m.end(0))
+
+    @staticmethod
+    def cmdrule():
+        """Rule of cmd. definition in current Cmd.syntax"""
+        return (core.Cmd.syntax.getcre('cmddef').pattern, TextScanner._cmdtoken)
+
+    @staticmethod
+    def inlrule(regex):
+        """Rule of inline code: linearized group 1 of regex is the code"""
+        return (regex, TextScanner._inltoken)
+
+    @staticmethod
+    def compile(rules, flags=0):
+        """Returns (compiled re, [(handler, groups offset)] for each group
+        index) of rules (cached). Rules are not wrapped in capturing groups,
+        so re can use first symbols of rules to skip text fast
+        """
+        key = (tuple(rules), flags)
+        result = TextScanner._cache.get(key)
+        if result is None:
+            regexes = []
+            handlers = [None]
+            for regex, handler in rules:
+                ngroups = re.compile(regex, flags).groups
+                if not ngroups:
+                    raise ValueError("rule '%s' has not groups"%regex)
+                handlers.extend([(handler, len(handlers) - 1)]*ngroups)
+                regexes.append('(?:%s)'%regex)
+            result = (re.compile('|'.join(regexes), flags), handlers)
+            TextScanner._cache[key] = result
+        return result
+
+    @staticmethod
+    def tokens(rules, text, flags=0):
+        """Returns tokens of text (terminated with EndToken) found by rules,
+        flags are re flags of all rules
+        """
+        cre, handlers = TextScanner.compile(rules, flags)
+        tokens = []
+        for m in cre.finditer(text):
+            handler, offset = handlers[m.lastindex]
+            token = handler(m, offset)
+            if token is not None:
+                tokens.append(token)
+        tokens.append(core.EndToken(None))
+        return tokens
+
+################################################################################
+
 class MDParser(core.Parser):
     """Markdown parser
 
@@ -97,41 +175,22 @@ class MDParser(core.Parser):
         >>> toks[3].text.endswith('return -a')
         True
         """
-        # left padding fragment of code-block
-        indents = (4*' ', '\t') # possible padding
-        indents = '|'.join(re.escape(s) for s in indents)
-
-        _inlcode_re = r'`([^`]+)`'
-        _blkcode_re = r'^\n(?P<code>((%s)(.*?)\n|\n)+)$' % indents
-        _blkcode_lstrip_re = '^(%s)' % indents
-
-        inlcode_re = re.compile(_inlcode_re)
-        blkcode_re = re.compile(_blkcode_re, re.MULTILINE)
-        blkcode_lstrip_re = re.compile(_blkcode_lstrip_re, re.MULTILINE)
-
-        cmds = core.Cmd.syntax.findtokens('cmddef', text)
-        inlcodes = inlcode_re.finditer(text)
-        blkcodes = blkcode_re.finditer(text)
-
-        tokens = []
+        rules = (TextScanner.cmdrule(), TextScanner.inlrule(MDParser._inlcode_re),
+                (MDParser._blkcode_re, MDParser._blktoken))
+        return TextScanner.tokens(rules, text, re.MULTILINE)
 
-        for m in cmds:
-            token = core.CmdToken(m.group(1), m.start(0), m.end(0))
-            tokens.append(token)
-        for m in inlcodes:
-            tokentext = core.InlCodeToken.linearize(m.group(1))
-            token = core.InlCodeToken(tokentext, m.start(0), m.end(0))
-            tokens.append(token)
-        for m in blkcodes:
-            # find each block and replace first left indent with ''
-            tokentext = m.group('code').strip('\n')
-            tokentext = blkcode_lstrip_re.sub('', tokentext)
-            token = core.BlkCodeToken(tokentext, m.start(0), m.end(0))
-            tokens.append(token)
+    ## left padding fragments of code-block
+    _indents = '|'.join(re.escape(s) for s in (4*' ', '\t'))
+    _inlcode_re = r'`([^`]+)`'
+    _blkcode_re = r'^\n((?:(?:%s).*?\n|\n)+)$' % _indents
+    _blkcode_lstrip_cre = re.compile('^(%s)' % _indents, re.MULTILINE)
 
-        tokens.sort(key=lambda tok: tok.start)
-        tokens.append(core.EndToken(None))
-        return tokens
+    @staticmethod
+    def _blktoken(m, i):
+        # replace first left indent of each line with ''
+        tokentext = m.group(i + 1).strip('\n')
+        tokentext = MDParser._blkcode_lstrip_cre.sub('', tokentext)
+        return core.BlkCodeToken(tokentext, m.start(0), m.end(0))
 core.Parser.register(MDParser)
 
 ################################################################################
@@ -188,27 +247,15 @@ class CreoleParser(core.Parser):
         # XXX Only block chunks, inline and block Creole chunks are the same.
         # In real Creole distinguish block|inline chunks, but it's not
         # valuable for LP
-        _blkcode_re = r'{{{\n*(?P<code>.*?)[\ \n]*}}}'
+        rules = (TextScanner.cmdrule(), (CreoleParser._blkcode_re, CreoleParser._blktoken))
+        return TextScanner.tokens(rules, text)
 
-        blkcode_re = re.compile(_blkcode_re, re.DOTALL|re.MULTILINE)
+    ## '.' of cmd. definition does not match new-line, so block uses [\s\S]
+    _blkcode_re = r'{{{\n*([\s\S]*?)[\ \n]*}}}'
 
-        cmds = core.Cmd.syntax.findtokens('cmddef', text)
-        blkcodes = blkcode_re.finditer(text)
-
-        tokens = []
-
-        for m in cmds:
-            token = core.CmdToken(m.group(1), m.start(0), m.end(0))
-            tokens.append(token)
-        for m in blkcodes:
-            # find each block and replace first left indent with ''
-            tokentext = m.group('code')
-            token = core.BlkCodeToken(tokentext, m.start(0), m.end(0))
-            tokens.append(token)
-
-        tokens.sort(key=lambda tok: tok.start)
-        tokens.append(core.EndToken(None))
-        return tokens
+    @staticmethod
+    def _blktoken(m, i):
+        return core.BlkCodeToken(m.group(i + 1), m.start(0), m.end(0))
 core.Parser.register(CreoleParser)
 
 ################################################################################
@@ -266,35 +313,19 @@ class RSTParser(core.Parser):
         True
         """
 
-        _inlcode_re = r'``([^`]+)``'
-        _blkcode_re = r'::\n\n(?P<code>.*?)(?:$|(?:\n\n[^ \t]+))'
-
-        inlcode_re = re.compile(_inlcode_re)
-        blkcode_re = re.compile(_blkcode_re, re.DOTALL)
-
-        cmds = core.Cmd.syntax.findtokens('cmddef', text)
-        inlcodes = inlcode_re.finditer(text)
-        blkcodes = blkcode_re.finditer(text)
+        rules = (TextScanner.cmdrule(), TextScanner.inlrule(RSTParser._inlcode_re),
+                (RSTParser._blkcode_re, RSTParser._blktoken))
+        return TextScanner.tokens(rules, text)
 
-        tokens = []
+    _inlcode_re = r'``([^`]+)``'
+    ## next paragraph ends block but is not consumed (it can start with cmd.)
+    _blkcode_re = r'::\n\n([\s\S]*?)(?:$|(?=\n\n[^ \t]))'
 
-        for m in cmds:
-            token = core.CmdToken(m.group(1), m.start(0), m.end(0))
-            tokens.append(token)
-        for m in inlcodes:
-            tokentext = core.InlCodeToken.linearize(m.group(1))
-            token = core.InlCodeToken(tokentext, m.start(0), m.end(0))
-            tokens.append(token)
-        for m in blkcodes:
-            # find each block and replace first left indent with ''
-            tokentext = m.group('code').strip('\n')
-            tokentext = core.deltextindent(tokentext)
-            token = core.BlkCodeToken(tokentext, m.start(0), m.end(0))
-            tokens.append(token)
-
-        tokens.sort(key=lambda tok: tok.start)
-        tokens.append(core.EndToken(None))
-        return tokens
+    @staticmethod
+    def _blktoken(m, i):
+        tokentext = m.group(i + 1).strip('\n')
+        tokentext = core.deltextindent(tokentext)
+        return core.BlkCodeToken(tokentext, m.start(0), m.end(0))
 core.Parser.register(RSTParser)
 
 ################################################################################
@@ -354,37 +385,21 @@ class Txt2TagsParser(core.Parser):
         '$ ls -F1'
         """
 
-        _inlcode_re = r'``([^\n`]+)``'
-        _blkcode_re1 = r'(?:\n|^)```(?P<code>[^\n]+)(?:\n|$)'
-        _blkcode_re2 = r'(?:\n|^)```\n+(?P<code>.*?)\n```(?:\n|$)'
+        rules = (TextScanner.cmdrule(), TextScanner.inlrule(Txt2TagsParser._inlcode_re),
+                (Txt2TagsParser._blkcode_re1, Txt2TagsParser._blktoken),
+                (Txt2TagsParser._blkcode_re2, Txt2TagsParser._blktoken))
+        return TextScanner.tokens(rules, text)
 
-        inlcode_re = re.compile(_inlcode_re)
-        blkcode_re1 = re.compile(_blkcode_re1, re.DOTALL)
-        blkcode_re2 = re.compile(_blkcode_re2, re.DOTALL)
+    _inlcode_re = r'``([^\n`]+)``'
+    ## block starts after new-line, even consumed by previous block
+    _blkcode_re1 = r'(?:\n|^|(?<=\n))```([^\n]+)(?:\n|$)'
+    _blkcode_re2 = r'(?:\n|^|(?<=\n))```\n+([\s\S]*?)\n```(?:\n|$)'
 
-        cmds = core.Cmd.syntax.findtokens('cmddef', text)
-        inlcodes = inlcode_re.finditer(text)
-        blkcodes = itertools.chain(blkcode_re1.finditer(text), blkcode_re2.finditer(text))
-
-        tokens = []
-
-        for m in cmds:
-            token = core.CmdToken(m.group(1), m.start(0), m.end(0))
-            tokens.append(token)
-        for m in inlcodes:
-            tokentext = core.InlCodeToken.linearize(m.group(1))
-            token = core.InlCodeToken(tokentext, m.start(0), m.end(0))
-            tokens.append(token)
-        for m in blkcodes:
-            # find each block and replace first left indent with ''
-            tokentext = m.group('code').strip('\n')
-            tokentext = core.deltextindent(tokentext)
-            token = core.BlkCodeToken(tokentext, m.start(0), m.end(0))
-            tokens.append(token)
-
-        tokens.sort(key=lambda tok: tok.start)
-        tokens.append(core.EndToken(None))
-        return tokens
+    @staticmethod
+    def _blktoken(m, i):
+        tokentext = m.group(i + 1).strip('\n')
+        tokentext = core.deltextindent(tokentext)
+        return core.BlkCodeToken(tokentext, m.start(0), m.end(0))
 core.Parser.register(Txt2TagsParser)
 
 ################################################################################
@@ -443,35 +458,18 @@ class AsciiDocParser(core.Parser):
         True
         """
 
-        _inlcode_re = r'\+([^\n\+]+)\+'
-        _blkcode_re = r'(?:\[source[^]]*?]\n|\n\n)-{4,}(?P<code>.*?)\n-{4,}'
-
-        inlcode_re = re.compile(_inlcode_re)
-        blkcode_re = re.compile(_blkcode_re, re.DOTALL)
-
-        cmds = core.Cmd.syntax.findtokens('cmddef', text)
-        inlcodes = inlcode_re.finditer(text)
-        blkcodes = blkcode_re.finditer(text)
+        rules = (TextScanner.cmdrule(), TextScanner.inlrule(AsciiDocParser._inlcode_re),
+                (AsciiDocParser._blkcode_re, AsciiDocParser._blktoken))
+        return TextScanner.tokens(rules, text)
 
-        tokens = []
+    _inlcode_re = r'\+([^\n\+]+)\+'
+    _blkcode_re = r'(?:\[source[^]]*?]\n|\n\n)-{4,}([\s\S]*?)\n-{4,}'
 
-        for m in cmds:
-            token = core.CmdToken(m.group(1), m.start(0), m.end(0))
-            tokens.append(token)
-        for m in inlcodes:
-            tokentext = core.InlCodeToken.linearize(m.group(1))
-            token = core.InlCodeToken(tokentext, m.start(0), m.end(0))
-            tokens.append(token)
-        for m in blkcodes:
-            # find each block and replace first left indent with ''
-            tokentext = m.group('code').strip('\n')
-            tokentext = core.deltextindent(tokentext)
-            token = core.BlkCodeToken(tokentext, m.start(0), m.end(0))
-            tokens.append(token)
-
-        tokens.sort(key=lambda tok: tok.start)
-        tokens.append(core.EndToken(None))
-        return tokens
+    @staticmethod
+    def _blktoken(m, i):
+        tokentext = m.group(i + 1).strip('\n')
+        tokentext = core.deltextindent(tokentext)
+        return core.BlkCodeToken(tokentext, m.start(0), m.end(0))
 core.Parser.register(AsciiDocParser)
 
 ################################################################################
@@ -565,37 +563,23 @@ class TeXParser(core.Parser):
         _inltext = r'{(?P<code1>.+?)}|(?P<s>[+#!])(?P<code2>.+?)(?P=s)'
         _blkcmds = '|'.join(re.escape(s) for s in TeXParser.blkcmds)
 
-        _inlcode_re = r'\\(%s)%s'%(_inlcmds, _inltext)
-        _blkcode_re = r'\\begin(\[.+?\])?{(%s)}(?P<code>.*?)\\end{(%s)}'%(_blkcmds, _blkcmds)
-
-        inlcode_re = re.compile(_inlcode_re)
-        blkcode_re = re.compile(_blkcode_re, re.DOTALL)
-
-        cmds = core.Cmd.syntax.findtokens('cmddef', text)
-        inlcodes = inlcode_re.finditer(text)
-        blkcodes = blkcode_re.finditer(text)
+        _inlcode_re = r'\\(?:%s)(?:%s)'%(_inlcmds, _inltext)
+        _blkcode_re = r'\\begin(?:\[.+?\])?{(?:%s)}(?P<code>[\s\S]*?)\\end{(?:%s)}'%(_blkcmds, _blkcmds)
 
-        tokens = []
+        rules = (TextScanner.cmdrule(), (_inlcode_re, TeXParser._inltoken),
+                (_blkcode_re, TeXParser._blktoken))
+        return TextScanner.tokens(rules, text)
 
-        for m in cmds:
-            token = core.CmdToken(m.group(1), m.start(0), m.end(0))
-            tokens.append(token)
-        for m in inlcodes:
-            groups = m.groupdict()
-            g = 'code1' if groups['code1'] else 'code2'
-            tokentext = core.InlCodeToken.linearize(m.group(g))
-            token = core.InlCodeToken(tokentext, m.start(0), m.end(0))
-            tokens.append(token)
-        for m in blkcodes:
-            # find each block and replace first left indent with ''
-            tokentext = m.group('code').lstrip('\n').rstrip('\n ')
-            tokentext = core.deltextindent(tokentext)
-            token = core.BlkCodeToken(tokentext, m.start(0), m.end(0))
-            tokens.append(token)
+    @staticmethod
+    def _inltoken(m, i):
+        code = m.group('code1') or m.group('code2')
+        return core.InlCodeToken(core.InlCodeToken.linearize(code), m.start(0), m.end(0))
 
-        tokens.sort(key=lambda tok: tok.start)
-        tokens.append(core.EndToken(None))
-        return tokens
+    @staticmethod
+    def _blktoken(m, i):
+        tokentext = m.group('code').lstrip('\n').rstrip('\n ')
+        tokentext = core.deltextindent(tokentext)
+        return core.BlkCodeToken(tokentext, m.start(0), m.end(0))
 core.Parser.register(TeXParser)
 
 ################################################################################
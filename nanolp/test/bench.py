@@ -0,0 +1,98 @@
+# Itself testing facilities. Benchmarks, run as:
+#   python -m nanolp.test.bench [NBLOCKS]
+#   python -m nanolp.test.bench throughput [NBLOCKS]
+#
+# Author: Balkansoft.BlogSpot.com
+# GNU GPL licensed
+
+import sys
+import time
+from nanolp import core
+from nanolp import parsers
+
+MDBLOCK = 'Chunk <<c.n%d>> is `inline code %d`:\n\n    line %d\n    <<=c.n%d>>\n\n'
+
+def mkdocument(nblocks):
+    """Markdown document with nblocks of chunk definitions, each has
+    cmd. definition, inline code and code block
+    """
+    return ''.join(MDBLOCK%(i, i, i, i + 1) for i in range(nblocks))
+
+## {parser class: block of document with cmd. definition, inline code (if
+## format has it) and code block}
+BLOCKS = {
+    parsers.MDParser: MDBLOCK,
+    parsers.CreoleParser: 'Chunk <<c.n%d>> is:\n{{{\n    line %d\n    <<=c.n%d>>\n}}}\n\n',
+    parsers.RSTParser: 'Chunk <<c.n%d>> is ``inline code %d``::\n\n    line %d\n    <<=c.n%d>>\n\nText.\n\n',
+    parsers.Txt2TagsParser: 'Chunk <<c.n%d>> is ``inline code %d``:\n```\n    line %d\n    <<=c.n%d>>\n```\n\n',
+    parsers.AsciiDocParser: 'Chunk <<c.n%d>> is +inline code %d+:\n\n----\nline %d\n<<=c.n%d>>\n----\n\n',
+    parsers.TeXParser: 'Chunk <<c.n%d>> is \\verb#inline code %d#:\n\\begin{verbatim}\nline %d\n<<=c.n%d>>\n\\end{verbatim}\n\n',
+}
+
+def mkformatdocument(parser_class, nblocks):
+    """Document of parser_class format with nblocks"""
+    block = BLOCKS[parser_class]
+    nfields = block.count('%d')
+    return ''.join(block%((i,)*(nfields - 1) + (i + 1,)) for i in range(nblocks))
+
+def throughput(nblocks=20000, repeat=3):
+    """Returns list of (parser class name, document size, number of tokens,
+    best time of tokens() in seconds)
+    """
+    result = []
+    for parser_class in sorted(BLOCKS, key=lambda cls: cls.__name__):
+        text = mkformatdocument(parser_class, nblocks)
+        parser = parser_class()
+        best = None
+        for _ in range(repeat):
+            t0 = time.time()
+            ntokens = len(parser.tokens(text))
+            t = time.time() - t0
+            best = t if best is None else min(best, t)
+        result.append((parser_class.__name__, len(text), ntokens, best))
+    return result
+
+class DictObj:
+    """Usual object with __dict__ (as tokens, chunks were before __slots__)"""
+    def __init__(self, attrs):
+        for name, value in attrs:
+            setattr(self, name, value)
+
+def objsize(obj):
+    """Size of object with it's __dict__ (without attributes values)"""
+    size = sys.getsizeof(obj)
+    d = getattr(obj, '__dict__', None)
+    if d is not None:
+        size += sys.getsizeof(d)
+    return size
+
+def memory(nblocks=70000):
+    """Returns list of (name, number of objects, size of slotted objects,
+    size of the same objects with __dict__)
+    """
+    text = mkdocument(nblocks)
+    tokens = parsers.MDParser().tokens(text)
+    chunks = [core.Chunk(tok.text) for tok in tokens if isinstance(tok, core.BlkCodeToken)]
+    infos = [core.VfileInfo(fmt='md', name='f%d.md'%i, mode=0o644, atime=i, mtime=i)
+            for i in range(nblocks)]
+    result = []
+    for name, objs, slots in (('tokens', tokens, core.Token.__slots__),
+            ('chunks', chunks, core.Chunk.__slots__),
+            ('vfileinfos', infos, core.VfileInfo.__slots__)):
+        size = sum(objsize(obj) for obj in objs)
+        dictsize = sum(objsize(DictObj((a, getattr(obj, a)) for a in slots)) for obj in objs)
+        result.append((name, len(objs), size, dictsize))
+    return result
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['throughput']:
+        nblocks = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+        for name, size, ntokens, t in throughput(nblocks):
+            sys.stdout.write('%-15s %9d bytes, %7d tokens: %.3f sec, %.2f MB/sec\n'%(name,
+                size, ntokens, t, size/t/1e6 if t else 0.))
+        sys.exit(0)
+    nblocks = int(sys.argv[1]) if len(sys.argv) > 1 else 70000
+    for name, n, size, dictsize in memory(nblocks):
+        sys.stdout.write('%-10s %7d objects: %10d bytes (%d per object), with __dict__: '
+                '%10d bytes (%d per object), -%d%%\n'%(name, n, size, size//n,
+                    dictsize, dictsize//n, 100 - 100*size//dictsize))
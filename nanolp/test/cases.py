@@ -5,6 +5,7 @@
 
 from nanolp import core
 from nanolp import commands
+from nanolp import fetchers
 from nanolp import parsers
 from nanolp import utils
 from nanolp import lp
@@ -18,11 +19,12 @@ import time
 import shutil
 import getopt
 import random
+import string
 import subprocess
 import re
 
 ## modules to be tested with docstrings
-DOCTESTMODULES = (core, parsers, utils)
+DOCTESTMODULES = (core, commands, fetchers, parsers, utils)
 
 class TestCfg:
     """Interface to config params"""
@@ -275,6 +277,104 @@ class TestDocStrings(ut.TestSuite):
 
 ################################################################################
 
+def legacy_parseheader(text):
+    """Parser of cmd. text as it was before Cmd.parseheader() lexer: escaped
+    symbols were quoted with replace() for each punctuation symbol. Returns
+    (ispaste, path, args, body) or raises CmdError. Quoted symbols in path and
+    in '*' args are restored as '\\X' (lexer keeps them so)
+    """
+    def _quote_text(txt):
+        for i,q in enumerate(core.CMDQUOTE):
+            txt = txt.replace(r'\%s'%q, '@Q%d@'%i)
+        return txt
+    def _unquote_text(txt):
+        for i,q in enumerate(core.CMDQUOTE):
+            txt = txt.replace('@Q%d@'%i, q)
+        return txt
+    def _escaped(txt):
+        return re.sub(r'@Q(\d+)@', lambda m: '\\' + core.CMDQUOTE[int(m.group(1))], txt)
+
+    _ArgNameDeniedSymbols = string.punctuation.replace('.', '')
+    if not core.Cmd.syntax.istoken('cmddef', text) \
+            and not core.Cmd.syntax.istoken('cmdsubst', text):
+        raise core.CmdError('mismatch form')
+    text = _quote_text(core.Cmd.syntax.strip(text))
+    tmp = [t.strip() for t in text.split(',')]
+    pathpart, argtexts = tmp[0], tmp[1:]
+    if not pathpart:
+        raise core.CmdError('empty path')
+    ispaste = pathpart[0] == '='
+    path = [_escaped(p) for p in (pathpart[1:] if ispaste else pathpart).split('.')]
+    args = []; body = []
+    for arg in argtexts:
+        if not arg:
+            raise core.CmdError('missed arg')
+        tmp = [t.strip() for t in arg.split(':', 1)]
+        if len(tmp) == 1:
+            body.append(_unquote_text(tmp[0]))
+        elif tmp[0] == '*':
+            if tmp[1] == '*':
+                args.append(('novars', True))
+            elif tmp[1].startswith('$'):
+                args.append(('varsdict', _escaped(tmp[1][1:])))
+        else:
+            if any(tmp0ch in _ArgNameDeniedSymbols for tmp0ch in tmp[0]):
+                raise core.CmdError("arg '%s' contains unallowed symbols"%_escaped(tmp[0]))
+            args.append((_unquote_text(tmp[0]), _unquote_text(tmp[1])))
+    return (ispaste, tuple(path), tuple(args), tuple(body))
+
+class TestCmdLexer(NanoLPTestCase):
+    """Fuzz test: Cmd.parseheader() gives the same as legacy_parseheader() on
+    texts of Cmd.parse() doctests and on their random mutations. Legacy parser
+    mangles '\\' before escaped symbol and '@Q' text, such texts are skipped
+    """
+    ## number of mutations
+    ntexts = 20000
+    ## pieces for mutations
+    pieces = (',', ':', ' ', '.', '=', '*', '$', '!', '@', 'a', 'x', '1', '*:*', '*:$',
+            '\\,', '\\:', '\\*', '\\$', '\\.', '\\@', '\\!', '\\a', '\\\\', '\\')
+
+    def __init__(self, seed=0):
+        NanoLPTestCase.__init__(self)
+        self.seed = seed
+
+    @staticmethod
+    def _result(parse, text):
+        try:
+            return parse(text)
+        except core.CmdError as x:
+            return ('CmdError', str(x))
+
+    def runTest(self, *args):
+        seeds = []
+        for example in dt.DocTestParser().get_examples(core.Cmd.parse.__doc__):
+            for m in re.finditer(r"\.parse\(('.*?')\)", example.source):
+                seeds.append(eval(m.group(1)))
+        self.assertTrue(seeds)
+        mangled = re.compile(r'\\\\[%s]|Q'%re.escape(core.CMDQUOTE))
+        rnd = random.Random(self.seed)
+        ntested = 0
+        for i in range(self.ntexts):
+            text = rnd.choice(seeds)
+            if i:
+                # mutate inner text of cmd
+                chars = list(core.Cmd.syntax.strip(text))
+                for _ in range(rnd.randint(1, 4)):
+                    pos = rnd.randint(0, len(chars))
+                    chars[pos:pos + rnd.randint(0, 2)] = [rnd.choice(self.pieces)]
+                text = core.Cmd.syntax.surround('def', ''.join(chars))
+            if mangled.search(text):
+                continue
+            ntested += 1
+            header = self._result(core.Cmd.parseheader, text)
+            if isinstance(header, core.CmdHeader):
+                header = (header.ispaste, header.path, header.args, header.body)
+            self.assertEqual(header, self._result(legacy_parseheader, text),
+                    msgfmt("parsing of %r", text))
+        sys.stderr.write(msgfmt('%d texts', ntested, caption='CMDLEXER'))
+
+################################################################################
+
 class TestExamplesDirViaHTTP(TestExamplesDir):
     """Like TestExamplesDir but first run HTTP server to serve
     all files in example dir"""
@@ -293,7 +393,7 @@ class TestExamplesDirViaHTTP(TestExamplesDir):
             self.login, self.password = auth.split(':')
     def run(self, results):
         args = [sys.executable, "-m", 'nanolp.test.httpserver', '--host=%s'%_testcfg.HTTP_HOST,
-                '--port=%d'%_testcfg.HTTP_PORT, '--dir=%s'%self.indir]
+                '--port=%d'%_testcfg.HTTP_PORT, '--dir=%s'%self.indir, '--keep-alive']
         if self.login:
             args.extend(['--login=%s'%self.login, '--password=%s'%self.password])
         proc = subprocess.Popen(args, cwd=self.indir)
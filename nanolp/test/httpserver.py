@@ -18,7 +18,7 @@ def parse_cmdline():
     options = {}
 
     long_opts_with_arg = ['host', 'port', 'login', 'password', 'dir']
-    long_opts = ['%s='%o for o in long_opts_with_arg]
+    long_opts = ['%s='%o for o in long_opts_with_arg] + ['keep-alive']
 
     try:
         opts, args = getopt.getopt(sys.argv[1:], 'h', long_opts)
@@ -32,6 +32,8 @@ def parse_cmdline():
             _UsageAndExit = True
         elif o == '-q':
             options['q'] = True
+        elif o == '--keep-alive':
+            options['keep-alive'] = True
         elif o in ('--%s'%o for o in long_opts_with_arg):
             options[o.lstrip('-')] = v
 
@@ -42,10 +44,12 @@ def parse_cmdline():
 
 ################################################################################
 
-class TestHTTPServer(core.HTTPServer):
-    """HTTP server for tests"""
+class TestHTTPServer(core.ThreadingMixIn, core.HTTPServer):
+    """HTTP server for tests (each connection in own thread, so persistent
+    connections don't block others)"""
+    daemon_threads = True
     def __init__(self, addr=('', 80), handler=None):
-        if handler is None: handler = core.SimpleHTTPRequestHandler
+        if handler is None: handler = HTTPHandler
         core.HTTPServer.__init__(self, addr, handler)
 
     @staticmethod
@@ -58,10 +62,10 @@ class TestHTTPServer(core.HTTPServer):
         return auth
 
     @staticmethod
-    def create_server(host='', port=80, login=None, password=None, dir_=''):
+    def create_server(host='', port=80, login=None, password=None, dir_='', keepalive=False):
         if not login or not password:
             sys.stdout.write('Run as anonymous!\n')
-            handler = None
+            handler = HTTPHandler
         else:
             auth = TestHTTPServer.__mkauth(login, password)
             if dir_:
@@ -69,11 +73,18 @@ class TestHTTPServer(core.HTTPServer):
             OPTS = dict(login=login, password=password, auth=auth)
             AuthHTTPHandler.OPTS = OPTS
             handler = AuthHTTPHandler
+        # HTTP/1.1 - connections are persistent
+        handler.protocol_version = 'HTTP/1.1' if keepalive else 'HTTP/1.0'
         return TestHTTPServer(addr=(host, port), handler=handler)
 
 ################################################################################
 
-class AuthHTTPHandler(core.SimpleHTTPRequestHandler):
+class HTTPHandler(core.SimpleHTTPRequestHandler):
+    """Handler of HTTP requests of anonymous"""
+
+################################################################################
+
+class AuthHTTPHandler(HTTPHandler):
     """Handler of HTTP requests"""
     ## dictionary of options (login, host, port, so on...)
     OPTS = {}
@@ -83,12 +94,13 @@ class AuthHTTPHandler(core.SimpleHTTPRequestHandler):
         if auth != "Basic %s" % self.OPTS['auth']:
             self.send_response(401)
             self.send_header("WWW-Authenticate", 'Basic realm="%s"'%self.OPTS['login'])
+            self.send_header("Content-Length", "0")
             self.end_headers();
             return False
         return True
 
     def do_GET(self):
-        if self.__auth(): core.SimpleHTTPRequestHandler.do_GET(self)
+        if self.__auth(): HTTPHandler.do_GET(self)
 
 ################################################################################
 
@@ -100,7 +112,7 @@ def main():
     USAGE = \
 '''Simple http server for testing purpose only with basic authorization.
 Syntax: [-h] [--host=HOST] [--port=PORT] [--login=LOGIN] [--password=PASSWORD]
-[--dir=DIR]
+[--dir=DIR] [--keep-alive]
 Options:
     -h                   this help
     --host=HOST          bind  to this host name or IP (localhost default)
@@ -108,6 +120,7 @@ Options:
     --login=LOGIN        user name to login (anonymous default)
     --password=PASSWORD  user password
     --dir=DIR            browse directory (current dir default)
+    --keep-alive         persistent connections (HTTP/1.1)
 '''
     opts = parse_cmdline()
     if opts is None:
@@ -119,8 +132,10 @@ Options:
     login = opts.get('login', None)
     password = opts.get('password', None)
     dir_ = opts.get('dir', '')
+    keepalive = opts.get('keep-alive', False)
 
-    httpd = TestHTTPServer.create_server(host=host, port=port, login=login, password=password, dir_=dir_)
+    httpd = TestHTTPServer.create_server(host=host, port=port, login=login, password=password, dir_=dir_,
+            keepalive=keepalive)
     httpd.serve_forever()
 
 
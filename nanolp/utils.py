@@ -204,7 +204,7 @@ class RefsFile:
         yield '</div>'
 
         url_collection = []; jpath_collection = []
-        for cmd, chunk in self.parser.chunkdict.chunks.items():
+        for cmd, chunk in self.parser.chunkdict.items():
             url = snumerate(self.__url(cmd), url_collection)
             jpath = snumerate(cmd.jpath(), jpath_collection)
             yield '<h2><a name="%s">%s</a></h2>'%(url, jpath)
@@ -0,0 +1,2 @@
+from nanolp.test import cases
+cases.run(cases.TestCmdLexer())